@@ -1,16 +1,408 @@
-import time
+import gzip
+import hashlib
+import io
+import json
+import logging
 import os
-from dbif import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME
+import sqlite3
+import subprocess
+import tempfile
+from dataclasses import dataclass, asdict, field
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional
 
-# TODO - maybe encrypt the backup and send to cloud, keep last 3 backups
-def backup_db() -> int:
-    currentTime = time.strftime('%Y-%m-%d')
-    BACKUP_DIR = '/home/honza/projects/accounting2/backups'
-    BACKUP_FILE = f'{BACKUP_DIR}/accounting2-{currentTime}.sql'
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-    cmd = f'mysqldump -h {DB_HOST} -u {DB_USER} -p{DB_PASSWORD} {DB_NAME} > {BACKUP_FILE}'
-    return os.system(cmd)
+import dbif
+import migrations
+from enums import Settings
 
-def restore_db(filename: str) -> int:
-    cmd = f'mysql -h {DB_HOST} -u {DB_USER} -p{DB_PASSWORD} {DB_NAME} < {filename}'
-    return os.system(cmd)
+# the backups dir next to the application unless ACCOUNTING2_BACKUP_DIR says otherwise
+BACKUP_DIR = os.environ.get('ACCOUNTING2_BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups'))
+BACKUP_KEEP = 3                 # full backups kept, incremental ones are kept as long as the full backup they build on
+COPY_CHUNK = 1024 * 1024        # bytes read from mysqldump at once
+INCREMENTAL_TABLES = ['classifications', 'signatures', 'settings']      # small, always dumped whole
+MANIFEST_SUFFIX = '.json'
+
+class BackupError(Exception):
+    pass
+
+@dataclass
+class BackupManifest:
+    file: str                   # name of the dump in the backup dir
+    dbName: str
+    mode: str                   # 'full' or 'incremental'
+    compression: str            # 'gzip' or 'zstd'
+    createdAt: str              # DB time when the dump started, the next incremental backup takes rows modified since then
+    since: Optional[str]        # incremental only - rows modified since this time are included
+    size: int
+    sha256: str
+
+    def save(self, directory: str) -> None:
+        with open(os.path.join(directory, self.file + MANIFEST_SUFFIX), 'w') as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @staticmethod
+    def load(path: str) -> 'BackupManifest':
+        with open(path) as f:
+            return BackupManifest(**json.load(f))
+
+# counts and hashes the compressed bytes on the way to the file, the dump is never read back
+class HashingWriter:
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self) -> None:
+        self.f.flush()
+
+def open_compressed(f: HashingWriter, compression: str):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=10).stream_writer(f, closefd=False)
+    return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+
+def mysql_env() -> dict:
+    # the password is passed in the environment, not on the command line where any user sees it
+    return dict(os.environ, MYSQL_PWD=dbif.DB_PASSWORD)
+
+# the dump goes straight from the pipe into the compressor, progress gets the number of bytes dumped so far
+def dump_into(out, args: List[str], progress: Optional[Callable[[int], None]], dumpedBefore: int = 0) -> int:
+    dumped = dumpedBefore
+    with tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(['mysqldump', '-h', dbif.DB_HOST, '-u', dbif.DB_USER, '--single-transaction', *args],
+                                stdout=subprocess.PIPE, stderr=errors, env=mysql_env())
+        try:
+            while chunk := proc.stdout.read(COPY_CHUNK):
+                out.write(chunk)
+                dumped += len(chunk)
+                if progress is not None:
+                    progress(dumped)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.wait() != 0:
+            errors.seek(0)
+            raise BackupError(f'mysqldump failed with error code {proc.returncode}: {errors.read().decode(errors="replace").strip()}')
+    return dumped
+
+# a SQLite DB is dumped by the connection itself, as SQL text like mysqldump writes
+def dump_sqlite_into(out, progress: Optional[Callable[[int], None]]) -> None:
+    dumped, reported = 0, 0
+    with dbif.db_connection() as pooled:
+        for statement in pooled.conn.raw.iterdump():
+            data = (statement + '\n').encode()
+            out.write(data)
+            dumped += len(data)
+            if progress is not None and dumped - reported >= COPY_CHUNK:
+                progress(dumped)
+                reported = dumped
+    if progress is not None:
+        progress(dumped)
+
+def list_manifests(directory: str, dbName: str) -> List[BackupManifest]:
+    manifests = []
+    for name in os.listdir(directory):
+        if name.endswith(MANIFEST_SUFFIX):
+            try:
+                manifest = BackupManifest.load(os.path.join(directory, name))
+            except (OSError, ValueError, TypeError) as e:
+                logging.warning(f'ignoring backup manifest {name}: {e}')
+                continue
+            if manifest.dbName == dbName:
+                manifests.append(manifest)
+    return sorted(manifests, key=lambda m: m.createdAt)
+
+def incremental_header(since: str) -> bytes:
+    # the tag links of a changed transaction are replaced as a whole, removed signatures must not come back
+    lines = ['-- incremental backup, apply on top of the preceding backups', 'delete from signatures;']
+    ids = [row[0] for row in dbif.sql_query('select id from transactions where modifiedAt >= %s', [since])]
+    for i in range(0, len(ids), dbif.LOOKUP_CHUNK_SIZE):
+        lines.append(f'delete from tag_links where trans_id in ({",".join(map(str, ids[i:i + dbif.LOOKUP_CHUNK_SIZE]))});')
+    return ('\n'.join(lines) + '\n').encode()
+
+# deleted transactions leave no modified row behind - the trailer lists the ids of all transactions and the restore deletes
+# the ones not listed, with their tag links; the ids are read after the dump, a row deleted meanwhile is deleted on restore too
+def incremental_trailer() -> bytes:
+    lines = ['create temporary table backup_ids (id int primary key);']
+    ids = [row[0] for row in dbif.sql_query('select id from transactions')]
+    for i in range(0, len(ids), dbif.BULK_INSERT_ROWS):
+        lines.append(f'insert into backup_ids (id) values {",".join(f"({trId})" for trId in ids[i:i + dbif.BULK_INSERT_ROWS])};')
+    lines += ['delete from tag_links where trans_id not in (select id from backup_ids);',
+              'delete from transactions where id not in (select id from backup_ids);',
+              'drop temporary table backup_ids;']
+    return ('\n'.join(lines) + '\n').encode()
+
+# full: the whole DB, incremental: the transactions modified since the last backup with their tag links, the ids of all
+# transactions (for the deleted ones), plus the small tables whole
+def backup_db(incremental: bool = False, directory: str = BACKUP_DIR, progress: Optional[Callable[[int], None]] = None) -> BackupManifest:
+    os.makedirs(directory, exist_ok=True)
+    dbName = dbif.DB_NAME
+    sqlite = dbif.backend.name == 'sqlite'
+    if incremental and sqlite:
+        logging.info('a SQLite DB is always backed up whole')
+        incremental = False
+    since = dbif.get_setting(Settings.LAST_BACKUP.value) if incremental else None
+    if incremental and (since is None or not any(m.mode == 'full' for m in list_manifests(directory, dbName))):
+        logging.info('no full backup to build on, making a full backup')
+        incremental, since = False, None
+
+    createdAt = str(dbif.sql_query('select current_timestamp')[0][0])
+    compression = 'zstd' if zstandard is not None else 'gzip'
+    mode = 'incremental' if incremental else 'full'
+    # a SQLite DB name can be a path
+    fileStem = os.path.splitext(os.path.basename(dbName))[0]
+    fileName = f'accounting2-{fileStem}-{createdAt.replace(" ", "-").replace(":", "")}-{mode}.sql.{"zst" if compression == "zstd" else "gz"}'
+    path = os.path.join(directory, fileName)
+
+    # written under a temporary name, a backup that did not finish never looks like a valid one
+    partialPath = path + '.partial'
+    try:
+        with open(partialPath, 'wb') as f:
+            hashing = HashingWriter(f)
+            with open_compressed(hashing, compression) as out:
+                if sqlite:
+                    dump_sqlite_into(out, progress)
+                elif not incremental:
+                    dump_into(out, [dbName], progress)
+                else:
+                    out.write(incremental_header(since))
+                    options = ['--no-create-info', '--replace', '--skip-add-locks', '--skip-disable-keys']
+                    dumped = dump_into(out, [*options, f'--where=modifiedAt >= "{since}"', dbName, 'transactions'], progress)
+                    dumped = dump_into(out, [*options, f'--where=trans_id in (select id from transactions where modifiedAt >= "{since}")',
+                                             dbName, 'tag_links'], progress, dumped)
+                    dump_into(out, [*options, dbName, *INCREMENTAL_TABLES], progress, dumped)
+                    out.write(incremental_trailer())
+        os.replace(partialPath, path)
+    except BaseException:
+        if os.path.exists(partialPath):
+            os.remove(partialPath)
+        raise
+
+    manifest = BackupManifest(fileName, dbName, mode, compression, createdAt, since, hashing.size, hashing.sha256.hexdigest())
+    manifest.save(directory)
+    dbif.set_setting(Settings.LAST_BACKUP.value, createdAt)
+    rotate_backups(directory, dbName)
+    return manifest
+
+def rotate_backups(directory: str, dbName: str, keep: int = BACKUP_KEEP) -> None:
+    manifests = list_manifests(directory, dbName)
+    fulls = [m for m in manifests if m.mode == 'full']
+    if len(fulls) <= keep:
+        return
+    oldestKept = fulls[-keep].createdAt
+    for manifest in manifests:
+        if manifest.createdAt < oldestKept:
+            logging.info(f'removing old backup {manifest.file}')
+            for name in (manifest.file, manifest.file + MANIFEST_SUFFIX):
+                if os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+
+@dataclass
+class RestoreResult:
+    mode: str
+    rowCounts: Dict[str, int] = field(default_factory=dict)
+
+    def summary(self) -> str:
+        return '\n'.join(f'{table}: {count} rows' for table, count in self.rowCounts.items())
+
+# orphans that the foreign keys would catch, the checks are off while the dump is loaded
+INTEGRITY_CHECKS = {
+    'tag links of missing transactions': 'select count(*) from tag_links l left join transactions t on t.id = l.trans_id where t.id is null',
+    'tag links of missing classifications':
+        'select count(*) from tag_links l left join classifications c on c.id = l.cls_id where c.id is null',
+    'transactions of a missing type':
+        'select count(*) from transactions t left join classifications c on c.id = t.trType where t.trType is not null and c.id is null',
+    'transactions of a missing category':
+        'select count(*) from transactions t left join classifications c on c.id = t.category where t.category is not null and c.id is null',
+    'signatures of missing classifications':
+        'select count(*) from signatures s left join classifications c on c.id = s.cls_id where c.id is null',
+}
+
+# the manifest written with the backup, None for backups made before there were manifests
+def verify_backup(filename: str) -> Optional[BackupManifest]:
+    if not os.path.exists(filename + MANIFEST_SUFFIX):
+        logging.warning(f'{filename} has no manifest, it cannot be verified')
+        return None
+    manifest = BackupManifest.load(filename + MANIFEST_SUFFIX)
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(COPY_CHUNK):
+            sha256.update(chunk)
+    if sha256.hexdigest() != manifest.sha256:
+        raise BackupError(f'{filename} does not match its manifest, the file is damaged')
+    return manifest
+
+def open_decompressed(raw: BinaryIO, filename: str) -> BinaryIO:
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise BackupError('restoring a zstd backup needs the zstandard package')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw), COPY_CHUNK)
+    if filename.endswith('.gz'):
+        return io.BufferedReader(gzip.GzipFile(fileobj=raw, mode='rb'), COPY_CHUNK)
+    return raw
+
+# mysqldump writes every statement on its own line(s) ending with ";", newlines in values are escaped - a SQLite dump
+# keeps them, isComplete tells a statement end from a ";" at the end of a line inside a value
+# progress gets the part of the (compressed) file read so far
+def iter_statements(filename: str, progress: Optional[Callable[[float], None]] = None,
+                    isComplete: Optional[Callable[[str], bool]] = None) -> Iterator[str]:
+    fileSize = max(os.path.getsize(filename), 1)
+    with open(filename, 'rb') as raw, open_decompressed(raw, filename) as f:
+        statement: List[bytes] = []
+        for line in f:
+            if not statement and (line.startswith(b'--') or not line.strip()):
+                continue
+            statement.append(line)
+            if line.rstrip().endswith(b';'):
+                text = b''.join(statement).decode()
+                if isComplete is not None and not isComplete(text):
+                    continue
+                yield text
+                statement = []
+                if progress is not None:
+                    progress(raw.tell() / fileSize)
+
+def check_integrity(cursor) -> None:
+    problems = []
+    for description, sql in INTEGRITY_CHECKS.items():
+        cursor.execute(sql)
+        if (cnt := cursor.fetchone()[0]) > 0:
+            problems.append(f'{cnt} {description}')
+    if problems:
+        raise BackupError(f'the backup is not consistent: {", ".join(problems)}')
+
+def count_rows(cursor) -> Dict[str, int]:
+    cursor.execute(dbif.backend.tablesSql)
+    tables = [row[0] for row in cursor.fetchall()]
+    counts = {}
+    for table in tables:
+        cursor.execute(f'select count(*) from `{table}`')
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+def execute_dump(cursor, filename: str, progress: Optional[Callable[[float], None]]) -> None:
+    for statement in iter_statements(filename, progress):
+        cursor.execute(statement)
+        if cursor.with_rows:
+            cursor.fetchall()
+
+# a full dump drops and creates the tables, which cannot be rolled back - it is loaded into a staging DB, checked there and
+# swapped with the live tables by a single (atomic) rename, the live DB stays untouched until then
+def restore_full(filename: str, progress: Optional[Callable[[float], None]], onSwap: Optional[Callable[[], None]]) -> RestoreResult:
+    live = dbif.DB_NAME
+    staging, old = f'{live}_restore', f'{live}_old'
+    with dbif.db_transaction() as cursor:
+        cursor.execute(f'drop database if exists `{staging}`')
+        cursor.execute(f'create database `{staging}`')
+
+    # not from the pool, the pool keeps connections to the current DB only
+    stagingConn = dbif.PooledConnection(staging)
+    try:
+        cursor = stagingConn.conn.cursor()
+        # the dump creates the ngram full-text index, without this it would be built with stopwords, unlike migration 2
+        cursor.execute('set session foreign_key_checks = 0, unique_checks = 0, innodb_ft_enable_stopword = 0')
+        execute_dump(cursor, filename, progress)
+        stagingConn.conn.commit()
+        check_integrity(cursor)
+        result = RestoreResult('full', count_rows(cursor))
+
+        if onSwap is not None:
+            onSwap()
+        cursor.execute(f'show tables from `{live}`')
+        liveTables = [row[0] for row in cursor.fetchall()]
+        cursor.execute(f'drop database if exists `{old}`')
+        cursor.execute(f'create database `{old}`')
+        renames = [f'`{live}`.`{table}` to `{old}`.`{table}`' for table in liveTables]
+        renames += [f'`{staging}`.`{table}` to `{live}`.`{table}`' for table in result.rowCounts]
+        cursor.execute(f'rename table {", ".join(renames)}')
+        cursor.execute(f'drop database `{old}`')
+    finally:
+        try:
+            stagingConn.conn.cursor().execute(f'drop database if exists `{staging}`')
+        finally:
+            stagingConn.close()
+
+    # the pooled connections prepared their statements against the replaced tables
+    dbif.close_connections()
+    dbif.invalidate_cache()
+    # a backup made by an older version gets the schema changes made since then
+    migrations.migrate()
+    return result
+
+def remove_sqlite_files(path: str) -> None:
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+
+# the dump is loaded into a new DB file next to the live one, checked there and moved over it
+def restore_full_sqlite(filename: str, progress: Optional[Callable[[float], None]], onSwap: Optional[Callable[[], None]]) -> RestoreResult:
+    live = dbif.backend.db_path(dbif.DB_NAME)
+    staging = live + '.restore'
+    remove_sqlite_files(staging)
+    # the dump has its own "begin transaction" and "commit"
+    conn = sqlite3.connect(staging, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        for statement in iter_statements(filename, progress, sqlite3.complete_statement):
+            cursor.execute(statement)
+        check_integrity(cursor)
+        result = RestoreResult('full', count_rows(cursor))
+        cursor.execute('pragma journal_mode = delete')
+        if onSwap is not None:
+            onSwap()
+    except BaseException:
+        conn.close()
+        remove_sqlite_files(staging)
+        raise
+    conn.close()
+
+    # a WAL file left behind would be applied to the restored DB
+    dbif.close_connections()
+    for name in (live + '-wal', live + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+    os.replace(staging, live)
+    dbif.invalidate_cache()
+    migrations.migrate()
+    return result
+
+# an incremental dump only replaces rows, it is applied in one DB transaction that is rolled back if anything fails
+def restore_incremental(filename: str, progress: Optional[Callable[[float], None]], onSwap: Optional[Callable[[], None]]) -> RestoreResult:
+    with dbif.db_transaction() as cursor:
+        cursor.execute('set foreign_key_checks = 0, unique_checks = 0')
+        try:
+            execute_dump(cursor, filename, progress)
+            check_integrity(cursor)
+            cursor.execute('delete from rollups')
+            dbif.update_rollups(cursor, '1 = 1', [], 1)
+            result = RestoreResult('incremental', count_rows(cursor))
+            # the commit is the swap here
+            if onSwap is not None:
+                onSwap()
+        finally:
+            # the connection goes back to the pool
+            cursor.execute('set foreign_key_checks = 1, unique_checks = 1')
+    dbif.invalidate_cache()
+    return result
+
+# onSwap is called before the live DB is replaced - from then on the restore, including the migrations of the restored
+# DB, must run to its end
+def restore_db(filename: str, progress: Optional[Callable[[float], None]] = None,
+               onSwap: Optional[Callable[[], None]] = None) -> RestoreResult:
+    manifest = verify_backup(filename)
+    if manifest is not None and manifest.dbName != dbif.DB_NAME:
+        logging.warning(f'restoring a backup of {manifest.dbName} into {dbif.DB_NAME}')
+    if manifest is not None and manifest.mode == 'incremental':
+        return restore_incremental(filename, progress, onSwap)
+    if dbif.backend.name == 'sqlite':
+        return restore_full_sqlite(filename, progress, onSwap)
+    return restore_full(filename, progress, onSwap)
@@ -0,0 +1,289 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import dbif
+import migrations
+from csv_parser import CsvParser, CHUNK_SIZE
+from enums import ClsType, CsvType, TransactionStatus
+from signatures import signatures
+from transaction import Transaction, TagSet
+from transaction_filter import TransactionFilter
+from transaction_store import TransactionStore
+
+# python benchmark.py --rows 50000 --output new.json --compare old.json
+# the data are generated from the seed, two runs with the same arguments work on the same files and signatures
+
+BENCH_ROWS = 20000
+BENCH_SIGNATURES = 500
+BENCH_REPEAT = 3            # the fast cases run this many times, the best and the median time are reported
+BENCH_SEED = 42
+SAVE_EACH_ROWS = 1000       # Transaction.save writes one row per DB transaction, only this many are saved that way
+DUPLICATE_SHARE = 0.01      # part of the rows whose transaction identifier repeats an earlier one
+REGRESSION_RATIO = 1.2      # --compare fails when a median is this many times the baseline one
+FIRST_DATE = date(2015, 1, 1)
+
+TR_TYPE_CNT = 8             # with the categories this covers the fixed credit type and category ids
+CATEGORY_CNT = 16
+TAG_CNT = 8
+
+MERCHANTS = ['Albert', 'Billa', 'Lidl', 'Kaufland', 'Tesco', 'Penny Market', 'Globus', 'Rohlík.cz', 'Košík.cz', 'Alza.cz',
+             'Datart', 'Dr.Max', 'Benu lékárna', 'Shell', 'OMV', 'MOL', 'Benzina', 'České dráhy', 'RegioJet', 'Pražská energetika',
+             'ČEZ Prodej', 'Pražské vodovody', 'T-Mobile', 'O2 Czech Republic', 'Vodafone', 'Netflix', 'Spotify', 'IKEA',
+             'Hornbach', 'OBI', 'Decathlon', 'Sportisimo', 'Lékárna U Anděla', 'Restaurace U Fleků', 'Kavárna Slavia', 'Zásilkovna']
+CITIES = ['Praha', 'Brno', 'Ostrava', 'Plzeň', 'Liberec', 'Olomouc', 'České Budějovice', 'Hradec Králové', 'Ústí nad Labem', 'Pardubice']
+PAYMENT_KINDS = ['Platba kartou', 'Odchozí úhrada', 'Trvalý příkaz', 'Inkaso', 'Výběr z bankomatu', 'Příchozí úhrada']
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    rows: int
+    repeat: int
+    best: float                 # seconds
+    median: float
+    mean: float
+
+    @property
+    def rowsPerSecond(self) -> float:
+        return self.rows / self.best if self.best > 0 else 0.0
+
+    def as_json(self) -> Dict[str, Any]:
+        return dict(asdict(self), rowsPerSecond=round(self.rowsPerSecond, 1))
+
+def format_amount(amount: int, thousands: str) -> str:
+    crowns, hundredths = divmod(abs(amount), 100)
+    grouped = f'{crowns:,}'.replace(',', thousands)
+    return f'{"-" if amount < 0 else ""}{grouped},{hundredths:02d}'
+
+def random_account(rnd: random.Random) -> str:
+    return f'{rnd.randint(10, 999999)}-{rnd.randint(100000000, 9999999999)}/{rnd.choice(["0100", "0300", "0800", "2010", "5500", "6100"])}'
+
+def random_amount(rnd: random.Random) -> int:
+    # mostly small card payments, some larger transfers and an occasional income
+    if rnd.random() < 0.08:
+        return rnd.randint(1000000, 8000000)
+    return -rnd.choice([rnd.randint(1000, 50000), rnd.randint(50000, 500000), rnd.randint(500000, 5000000)])
+
+def random_description(rnd: random.Random) -> Tuple[str, str]:
+    merchant = rnd.choice(MERCHANTS)
+    return f'{rnd.choice(PAYMENT_KINDS)} {merchant}', f'{merchant}, {rnd.choice(CITIES)}'
+
+def transaction_identifiers(rowCnt: int, rnd: random.Random) -> List[str]:
+    identifiers = [f'{rnd.randint(10 ** 12, 10 ** 13 - 1)}-{i}' for i in range(rowCnt)]
+    for i in rnd.sample(range(1, rowCnt), int((rowCnt - 1) * DUPLICATE_SHARE)):
+        identifiers[i] = identifiers[rnd.randrange(i)]
+    return identifiers
+
+def quoted(fields: List[str]) -> str:
+    return ';'.join(f'"{f}"' for f in fields) + '\n'
+
+def write_kb_csv(filename: str, rowCnt: int, rnd: random.Random) -> None:
+    with open(filename, 'w', encoding='cp1250') as f:
+        for i, identifier in enumerate(transaction_identifiers(rowCnt, rnd)):
+            dueDate = FIRST_DATE + timedelta(days=i * 3650 // max(rowCnt, 1))
+            amount = random_amount(rnd)
+            foreign = rnd.random() < 0.05
+            system, sender = random_description(rnd)
+            f.write(quoted([
+                dueDate.strftime('%d.%m.%Y'), (dueDate + timedelta(days=rnd.randint(0, 2))).strftime('%d.%m.%Y'),
+                random_account(rnd), rnd.choice(MERCHANTS),
+                format_amount(amount, '.'), format_amount(amount // 25, '.') if foreign else '', 'EUR' if foreign else '',
+                '25,10' if foreign else '',
+                str(rnd.randint(1, 9999999999)) if rnd.random() < 0.3 else '', '0308' if rnd.random() < 0.2 else '', '',
+                identifier, system, sender, rnd.choice(CITIES) if rnd.random() < 0.5 else '',
+                f'{rnd.choice(MERCHANTS)} {rnd.randint(1, 999)}', rnd.choice(CITIES), '', ''
+            ]))
+
+def write_mb_csv(filename: str, rowCnt: int, rnd: random.Random) -> None:
+    balance = 10000000
+    with open(filename, 'w', encoding='cp1250') as f:
+        for i in range(rowCnt):
+            dueDate = FIRST_DATE + timedelta(days=i * 3650 // max(rowCnt, 1))
+            amount = random_amount(rnd)
+            balance += amount
+            system, sender = random_description(rnd)
+            f.write(quoted([
+                dueDate.strftime('%d-%m-%Y'), (dueDate + timedelta(days=rnd.randint(0, 2))).strftime('%d-%m-%Y'),
+                system, sender, rnd.choice(MERCHANTS), random_account(rnd), '0308' if rnd.random() < 0.2 else '',
+                str(rnd.randint(1, 9999999999)) if rnd.random() < 0.3 else '', '',
+                format_amount(amount, ' '), format_amount(balance, ' ')
+            ]))
+
+# the classifications are stored, the saved transactions refer to them - the first ids go to the types and categories,
+# so the fixed credit type and category ids are among them
+def create_classifications() -> Dict[ClsType, List[int]]:
+    counts = {ClsType.TR_TYPE: TR_TYPE_CNT, ClsType.CATEGORY: CATEGORY_CNT, ClsType.TAG: TAG_CNT}
+    return {cls: [dbif.add_new_classification(cls, f'bench {cls.name.lower()} {i}') for i in range(cnt)] for cls, cnt in counts.items()}
+
+# about a third of the signatures are merchant names that match the generated descriptions, the rest do not match anything
+def make_signatures(signatureCnt: int, clsIds: Dict[ClsType, List[int]], rnd: random.Random) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+    sets: Dict[ClsType, Dict[str, int]] = {cls: {} for cls in clsIds}
+    words = [m.lower() for m in MERCHANTS] + [c.lower() for c in CITIES]
+    for i in range(signatureCnt):
+        cls = (ClsType.TR_TYPE, ClsType.CATEGORY, ClsType.TAG)[i % 3]
+        signature = rnd.choice(words) if rnd.random() < 0.33 else f'{rnd.choice(words)[:4]}{i:05d}x'
+        sets[cls][signature] = rnd.choice(clsIds[cls])
+    return sets[ClsType.TR_TYPE], sets[ClsType.CATEGORY], sets[ClsType.TAG]
+
+def reset_classifications(transactions: List[Transaction]) -> None:
+    for t in transactions:
+        t.trType, t.category, t.tags, t.cachedSignature = None, None, TagSet(), None
+
+class Benchmark:
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: List[BenchmarkResult] = []
+
+    # setup runs before every repetition and is not timed
+    def timed(self, name: str, rows: int, func: Callable[[], Any], setup: Optional[Callable[[], None]] = None,
+              repeat: Optional[int] = None) -> Any:
+        times: List[float] = []
+        value = None
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            value = func()
+            times.append(time.perf_counter() - start)
+        result = BenchmarkResult(name, rows, len(times), min(times), statistics.median(times), statistics.fmean(times))
+        self.results.append(result)
+        logging.info(f'{name}: {result.median * 1000:.1f} ms median, {result.rowsPerSecond:.0f} rows/s')
+        return value
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(directory: str, rowCnt: int, signatureCnt: int, repeat: int, seed: int) -> List[BenchmarkResult]:
+    rnd = random.Random(seed)
+    bench = Benchmark(repeat)
+    kbFile, mbFile = os.path.join(directory, 'bench_kb.csv'), os.path.join(directory, 'bench_mb.csv')
+    write_kb_csv(kbFile, rowCnt, rnd)
+    write_mb_csv(mbFile, rowCnt, rnd)
+
+    clsIds = create_classifications()
+    signatureSets = make_signatures(signatureCnt, clsIds, rnd)
+    bench.timed('build_matcher', signatureCnt, lambda: signatures.set_signatures(*signatureSets))
+
+    # the import path: parse, classify, mark duplicates, save
+    transactions = bench.timed('parse_kb', rowCnt, lambda: CsvParser().read_transactions(kbFile, CsvType.KB))
+    mbTransactions = bench.timed('parse_mb', rowCnt, lambda: CsvParser().read_transactions(mbFile, CsvType.MB))
+    transactions += mbTransactions
+    bench.timed('find_classifications', len(transactions), lambda: [t.find_classifications() for t in transactions],
+                setup=lambda: reset_classifications(transactions))
+    bench.timed('mark_duplicates_new', len(transactions), lambda: Transaction.mark_duplicates(transactions))
+
+    toSave = [t for t in transactions if t.status == TransactionStatus.NEW and t.is_complete()]
+    eachCnt = min(SAVE_EACH_ROWS, len(toSave) // 10)
+    bench.timed('transaction_save', eachCnt, lambda: [t.save() for t in toSave[:eachCnt]], repeat=1)
+    rest = toSave[eachCnt:]
+    bench.timed('save_new_transactions', len(rest),
+                lambda: [dbif.save_new_transactions(rest[i:i + CHUNK_SIZE]) for i in range(0, len(rest), CHUNK_SIZE)], repeat=1)
+    bench.timed('mark_duplicates_saved', len(transactions), lambda: Transaction.mark_duplicates(transactions))
+
+    # the DB reads of the transaction table
+    savedCnt = dbif.count_transactions()
+    middle = dbif.get_transactions(limit=savedCnt // 2)[-1] if savedCnt > 1 else None
+    filters = {
+        'all': TransactionFilter(),
+        'description': TransactionFilter(description=rnd.choice(MERCHANTS).split()[0]),
+        'date_amount': TransactionFilter(dateFrom=FIRST_DATE + timedelta(days=365), dateTo=FIRST_DATE + timedelta(days=730), amountMin=500),
+        'category': TransactionFilter(categories=clsIds[ClsType.CATEGORY][:3]),
+        'tag': TransactionFilter(tags=clsIds[ClsType.TAG][:1]),
+    }
+    for name, flt in filters.items():
+        sqlFilter = flt.to_sql()
+        bench.timed(f'get_transactions_{name}', savedCnt, lambda: dbif.get_transactions(sqlFilter, limit=500))
+        bench.timed(f'get_transaction_totals_{name}', savedCnt, lambda: dbif.get_transaction_totals(sqlFilter))
+    if middle is not None:
+        bench.timed('get_transactions_keyset_page', savedCnt, lambda: dbif.get_transactions(after=(middle[1], middle[0]), limit=500))
+    bench.timed('get_rollups', savedCnt, lambda: dbif.get_rollups(ClsType.CATEGORY))
+
+    # the in-memory side of the GUI
+    store = bench.timed('store_extend', len(transactions), lambda: TransactionStore(transactions))
+    storeFilter = TransactionFilter(description=rnd.choice(MERCHANTS).split()[0], credit=False)
+    bench.timed('store_select', len(transactions), lambda: store.select(storeFilter))
+    bench.timed('store_sort', len(transactions), lambda: store.sort(list(range(len(store))), 'amounts'))
+    return bench.results
+
+# the names whose median got slower than REGRESSION_RATIO times the baseline one
+def find_regressions(report: Dict[str, Any], baseline: Dict[str, Any], ratio: float) -> List[str]:
+    baseMedians = {r['name']: r['median'] for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        base = baseMedians.get(r['name'])
+        if base and r['median'] > ratio * base:
+            regressions.append(f'{r["name"]}: {base * 1000:.1f} ms -> {r["median"] * 1000:.1f} ms')
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Times the import, classification, save and query paths on generated data')
+    parser.add_argument('--rows', type=int, default=BENCH_ROWS, help='rows of each generated CSV file')
+    parser.add_argument('--signatures', type=int, default=BENCH_SIGNATURES)
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT)
+    parser.add_argument('--seed', type=int, default=BENCH_SEED)
+    parser.add_argument('--backend', choices=['sqlite', 'mysql'], default='sqlite')
+    parser.add_argument('--database', help='an empty MySQL DB for --backend mysql, the SQLite DB is a temporary file')
+    parser.add_argument('--output', help='JSON file for the results, stdout by default')
+    parser.add_argument('--compare', help='JSON results of an earlier run, exit code 1 if anything got slower')
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix='accounting2-bench-') as directory:
+        dbif.set_backend(args.backend)
+        if args.backend == 'mysql':
+            if not args.database:
+                parser.error('--backend mysql needs --database')
+            dbif.set_database(args.database)
+        else:
+            dbif.set_database(os.path.join(directory, 'bench.sqlite3'))
+        migrations.migrate()
+        if dbif.count_transactions() > 0 or dbif.get_classifications():
+            parser.error(f'{dbif.DB_NAME} is not empty, the benchmark needs a DB of its own')
+        try:
+            results = run_benchmarks(directory, args.rows, args.signatures, args.repeat, args.seed)
+        finally:
+            dbif.close_connections()
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': args.backend,
+        'rows': args.rows,
+        'signatures': args.signatures,
+        'seed': args.seed,
+        'results': [r.as_json() for r in results],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(report, json.load(f), args.ratio)
+        for regression in regressions:
+            logging.warning(f'slower: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,29 @@
 import logging
-from datetime import datetime
-from typing import Optional, List
+import os
+import time
+from datetime import datetime, date
+from functools import lru_cache
+from typing import Optional, List, Iterator, Tuple, Callable
 
+import instrumentation
 from enums import CsvType, TransactionStatus
 from transaction import Transaction
 
 
+CHUNK_SIZE = 500
+
+# thousands and decimal separators, amounts are stored in hundredths
+AMOUNT_SEPARATORS_KB = str.maketrans('', '', '.,')
+AMOUNT_SEPARATORS_MB = str.maketrans('', '', '., ')
+
+# a statement contains only a few hundred distinct dates, strptime is expensive
+@lru_cache(maxsize=4096)
+def parse_date(value: str, dateFormat: str) -> date:
+    return datetime.strptime(value, dateFormat).date()
+
+def parse_amount(value: str, separators: dict) -> int:
+    return int(value.translate(separators))
+
 class CsvParser:
     def __init__(self):
         self.delimiter: str = ';'
@@ -13,15 +31,15 @@ class CsvParser:
         self.transactions: List[Transaction] = []
 
     def line_to_transaction_mb(self, line: str) -> Optional[Transaction]:
-        fields = list(map(lambda l: l.strip('"'), line.split(self.delimiter)))
+        fields = [f.strip('"') for f in line.split(self.delimiter)]
         if len(fields) < 11:
             logging.warning(f'Line {line} has only {len(fields)} fields, expected 11')
             return None
         try:
             return Transaction(
                 id = None,
-                dueDate = datetime.strptime(fields[0], '%d-%m-%Y').date(),
-                writeOffDate = datetime.strptime(fields[1], '%d-%m-%Y').date() if fields[1] else None,
+                dueDate = parse_date(fields[0], '%d-%m-%Y'),
+                writeOffDate = parse_date(fields[1], '%d-%m-%Y') if fields[1] else None,
                 senderDescription = fields[2],
                 addresseeDescription = fields[3],
                 toAccountName=fields[4],
@@ -29,7 +47,7 @@ class CsvParser:
                 constantSymbol=fields[6],
                 variableSymbol=fields[7],
                 specificSymbol=fields[8],
-                amount=int(fields[9].replace('.', '').replace(',', '').replace(' ', '')),
+                amount=parse_amount(fields[9], AMOUNT_SEPARATORS_MB),
                 bank='MB',
                 status=TransactionStatus.NEW
             )
@@ -38,19 +56,19 @@ class CsvParser:
             return None
 
     def line_to_transaction_kb(self, line: str) -> Optional[Transaction]:
-        fields = list(map(lambda l: l.strip('"'), line.split(self.delimiter)))
+        fields = [f.strip('"') for f in line.split(self.delimiter)]
         if len(fields) < 19:
             logging.warning(f'Line {line} has only {len(fields)} fields, expected 19')
             return None
         try:
             return Transaction(
                 id = None,
-                dueDate = datetime.strptime(fields[0], '%d.%m.%Y').date(),
-                writeOffDate = datetime.strptime(fields[1], '%d.%m.%Y').date() if fields[1] else None,
+                dueDate = parse_date(fields[0], '%d.%m.%Y'),
+                writeOffDate = parse_date(fields[1], '%d.%m.%Y') if fields[1] else None,
                 toAccount = fields[2],
                 toAccountName = fields[3],
-                amount = int(fields[4].replace('.', '').replace(',', '')),
-                originalAmount = int(fields[5].replace('.', '').replace(',', '')) if fields[5] else None,
+                amount = parse_amount(fields[4], AMOUNT_SEPARATORS_KB),
+                originalAmount = parse_amount(fields[5], AMOUNT_SEPARATORS_KB) if fields[5] else None,
                 originalCurrency = fields[6],
                 rate = float(fields[7].replace(',', '.')) if fields[6] else None,
                 variableSymbol = fields[8],
@@ -72,23 +90,44 @@ class CsvParser:
             return None
 
     def read_transactions(self, filename: str, sourceType: CsvType) -> List[Transaction]:
-        self.sourceType = sourceType
         self.transactions.clear()
         try:
-            with open(filename, 'r', encoding='cp1250') as f:
-                lines = f.readlines()
-                self.parse_data(lines)
-                return self.transactions
+            for chunk, _ in self.iter_transactions(filename, sourceType):
+                self.transactions.extend(chunk)
+            return self.transactions
         except FileNotFoundError:
             print(f'File {filename} not found')
         return []
 
-    def parse_data(self, lines: List[str]) -> None:
+    # reads the file lazily, yields parsed transactions in chunks together with the fraction of the file read so far
+    def iter_transactions(self, filename: str, sourceType: CsvType, chunkSize: int = CHUNK_SIZE) -> Iterator[Tuple[List[Transaction], float]]:
+        self.sourceType = sourceType
+        parse_func = self.get_parse_func()
+        fileSize = os.path.getsize(filename) or 1
+
+        with open(filename, 'r', encoding='cp1250') as f:
+            chunk: List[Transaction] = []
+            # the time of reading and parsing a chunk, without the time the consumer spends between the chunks
+            chunkStart = time.perf_counter()
+            for line in f:
+                if (t := parse_func(line)) is not None:
+                    chunk.append(t)
+                if len(chunk) >= chunkSize:
+                    instrumentation.record(instrumentation.KIND_IMPORT, 'parse', time.perf_counter() - chunkStart, len(chunk))
+                    yield chunk, min(f.buffer.tell() / fileSize, 1.0)
+                    chunk = []
+                    chunkStart = time.perf_counter()
+            instrumentation.record(instrumentation.KIND_IMPORT, 'parse', time.perf_counter() - chunkStart, len(chunk))
+            yield chunk, 1.0
+
+    def get_parse_func(self) -> Callable[[str], Optional[Transaction]]:
         if self.sourceType == CsvType.KB:
-            parse_func = self.line_to_transaction_kb
+            return self.line_to_transaction_kb
         elif self.sourceType == CsvType.MB:
-            parse_func = self.line_to_transaction_mb
+            return self.line_to_transaction_mb
         else:
             assert False, f'Unknown source type: {self.sourceType}'
 
+    def parse_data(self, lines: List[str]) -> None:
+        parse_func = self.get_parse_func()
         self.transactions = [t for t in map(parse_func, lines) if t is not None]
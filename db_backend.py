@@ -0,0 +1,173 @@
+import os
+import sqlite3
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Tuple
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_DIR = os.path.join(APP_DIR, 'data')          # DB name -> <SQLITE_DIR>/<name>.sqlite3, unless the name is a path
+SQLITE_BUSY_TIMEOUT = 10.0                          # seconds a connection waits for a write lock held by another one
+SETUP_SQL = os.path.join(APP_DIR, 'setup.sql')
+
+ROLLUP_COLUMNS = 'period, dim, dimKey, bank, debit, credit, cnt'
+
+# what differs between the DB servers - connecting, error handling and the few statements without a common syntax
+class MySqlBackend:
+    name = 'mysql'
+    fullText = True             # the description filter can use the full-text index
+    tablesSql = 'show tables'
+
+    def __init__(self, host: str, user: str, password: str):
+        # imported here, the SQLite backend works without the connector installed
+        import mysql.connector
+        self.connector = mysql.connector
+        self.Error = mysql.connector.Error
+        self.host, self.user, self.password = host, user, password
+
+    def connect(self, dbName: str):
+        return self.connector.connect(host=self.host, user=self.user, password=self.password, database=dbName)
+
+    def is_connection_lost(self, e: Exception, lostErrnos: set) -> bool:
+        return isinstance(e, (self.connector.InterfaceError, self.connector.OperationalError)) and e.errno in lostErrnos
+
+    @staticmethod
+    def month_start(column: str) -> str:
+        return f'{column} - interval (dayofmonth({column}) - 1) day'
+
+    # the default collation is case-insensitive, the index on the column stays usable
+    @staticmethod
+    def equals_ignore_case(column: str) -> str:
+        return f'{column} = %s'
+
+    # the select reads a derived table with its own debit, credit and cnt, unqualified names in the update would be ambiguous
+    @staticmethod
+    def add_to_rollups(selectSql: str) -> str:
+        return f'''
+            insert into rollups ({ROLLUP_COLUMNS}) {selectSql}
+            on duplicate key update rollups.debit = rollups.debit + values(debit), rollups.credit = rollups.credit + values(credit),
+                rollups.cnt = rollups.cnt + values(cnt)
+        '''
+
+    # batch of (id, trType, category), one statement for the whole batch
+    @staticmethod
+    def update_classifications(cursor, batch: List[Tuple[int, Optional[int], Optional[int]]]) -> None:
+        newValues = ' union all '.join(['select %s as id, %s as trType, %s as category'] * len(batch))
+        cursor.execute(f'update transactions as t join ({newValues}) as v on v.id = t.id '
+                       f'set t.trType = v.trType, t.category = v.category, t.modifiedAt = current_timestamp',
+                       [value for row in batch for value in row])
+
+# dates are stored as ISO strings and converted back by the declared column type
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(' '))
+sqlite3.register_converter('date', lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter('datetime', lambda value: datetime.fromisoformat(value.decode()))
+
+@lru_cache(maxsize=512)
+def qmark(sql: str) -> str:
+    return sql.replace('%s', '?')
+
+# the dbif statements use the "%s" parameter style of mysql.connector
+class SqliteCursor:
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    def execute(self, sql: str, params: Sequence = ()) -> None:
+        self.cursor.execute(qmark(sql), tuple(params))
+
+    def executemany(self, sql: str, rows: Sequence[Sequence]) -> None:
+        self.cursor.executemany(qmark(sql), rows)
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> List[tuple]:
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    @property
+    def with_rows(self) -> bool:
+        return self.cursor.description is not None
+
+    def close(self) -> None:
+        self.cursor.close()
+
+# sqlite3 keeps its own cache of prepared statements, a prepared cursor is an ordinary one
+class SqliteConnection:
+    def __init__(self, raw: sqlite3.Connection):
+        self.raw = raw
+
+    def cursor(self, prepared: bool = False) -> SqliteCursor:
+        return SqliteCursor(self.raw.cursor())
+
+    def ping(self, reconnect: bool = False) -> None:
+        pass
+
+    def commit(self) -> None:
+        self.raw.commit()
+
+    def rollback(self) -> None:
+        self.raw.rollback()
+
+    def close(self) -> None:
+        self.raw.close()
+
+class SqliteBackend:
+    name = 'sqlite'
+    fullText = False
+    tablesSql = "select name from sqlite_master where type = 'table' and name not like 'sqlite_%' order by name"
+    Error = sqlite3.Error
+
+    @staticmethod
+    def db_path(dbName: str) -> str:
+        if os.sep in dbName or dbName.endswith('.sqlite3'):
+            return dbName
+        return os.path.join(SQLITE_DIR, f'{dbName}.sqlite3')
+
+    def connect(self, dbName: str) -> SqliteConnection:
+        path = self.db_path(dbName)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # a pooled connection is used by one thread at a time, but not always by the one that opened it
+        raw = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT)
+        raw.execute('pragma journal_mode = wal')
+        raw.execute('pragma synchronous = normal')
+        raw.execute('pragma foreign_keys = on')
+        if raw.execute("select count(*) from sqlite_master where type = 'table' and name = 'settings'").fetchone()[0] == 0:
+            # a new DB gets the schema version 0, migrations.migrate() does the rest
+            with open(SETUP_SQL) as f:
+                raw.executescript(f.read())
+        return SqliteConnection(raw)
+
+    @staticmethod
+    def is_connection_lost(e: Exception, lostErrnos: set) -> bool:
+        return False
+
+    @staticmethod
+    def month_start(column: str) -> str:
+        return f"date({column}, 'start of month')"
+
+    @staticmethod
+    def equals_ignore_case(column: str) -> str:
+        return f'{column} = %s collate nocase'
+
+    @staticmethod
+    def add_to_rollups(selectSql: str) -> str:
+        # "where true" keeps the parser from reading "on conflict" as a join constraint
+        return f'''
+            insert into rollups ({ROLLUP_COLUMNS}) {selectSql} where true
+            on conflict (period, dim, dimKey, bank) do update set
+                debit = debit + excluded.debit, credit = credit + excluded.credit, cnt = cnt + excluded.cnt
+        '''
+
+    @staticmethod
+    def update_classifications(cursor, batch: List[Tuple[int, Optional[int], Optional[int]]]) -> None:
+        cursor.executemany('update transactions set trType = %s, category = %s, modifiedAt = current_timestamp where id = %s',
+                           [(trType, category, trId) for trId, trType, category in batch])
+
+def create_backend(name: str, host: str, user: str, password: str) -> Any:
+    if name == 'sqlite':
+        return SqliteBackend()
+    assert name == 'mysql', f'unknown DB backend {name}'
+    return MySqlBackend(host, user, password)
@@ -1,9 +1,15 @@
 from __future__ import annotations
+from contextlib import contextmanager
 from enum import Enum
-from typing import Set, TYPE_CHECKING, Optional, List, Tuple
-import mysql.connector
+from collections import OrderedDict
+from typing import Set, TYPE_CHECKING, Optional, List, Tuple, Dict, Iterator, Iterable, Sequence, Any
+import os
+import threading
+import time
+import instrumentation
+from db_backend import create_backend
 from enums import ClsType
-from utils import value_or_null
+from utils import description_words
 from datetime import date
 
 if TYPE_CHECKING:
@@ -17,6 +23,19 @@ DB_NAME_REAL = 'accounting2'
 DB_NAME_TEST = 'accounting2_test'
 DB_NAME = DB_NAME_REAL
 
+# "mysql", or "sqlite" for an embedded DB in a local file (see db_backend.SQLITE_DIR)
+DB_BACKEND = os.environ.get('ACCOUNTING2_DB_BACKEND', 'mysql')
+backend = create_backend(DB_BACKEND, DB_HOST, DB_USER, DB_PASSWORD)
+
+POOL_SIZE = 4               # idle connections kept per database
+POOL_PING_AFTER = 60.0      # seconds of idleness after which a pooled connection is pinged before reuse
+CONNECTION_LOST_ERRNOS = {2006, 2013, 2055}     # server gone away, lost connection during query, lost connection to server
+PREPARED_CACHE_SIZE = 64    # prepared statements kept per connection
+BULK_INSERT_ROWS = 1000     # rows per multi-row insert statement
+LOOKUP_CHUNK_SIZE = 1000    # values per "in (...)" lookup
+NO_CLS_ID = -1              # classification id of unclassified transactions in the rollups
+FULLTEXT_MIN_TERM = 2       # ngram_token_size of the server, shorter terms cannot be looked up in the full-text index
+
 class Table(Enum):
     TRANSACTIONS = 'transactions'
     SIGNATURES = 'signatures'
@@ -29,121 +48,422 @@ transactionFieldsSelect = ["id", "dueDate", "amount", "bank", "category", "trTyp
 
 transactionFieldsSave = transactionFieldsSelect + ['signature']
 
+# where clause (starting with " where ", or empty) and its parameters
+SqlFilter = Tuple[str, List[Any]]
+
 def get_setting(key: str) -> Optional[str]:
-    retval = sql_query(f'select sValue from settings where sKey = "{key}"')
+    retval = sql_query('select sValue from settings where sKey = %s', [key])
     if len(retval) == 0:
         return None
     else:
         return retval[0][0]
 
 def set_setting(key: str, value: str) -> None:
-    sql_query(f'delete from settings where sKey = "{key}"')
-    sql_query(f'insert into settings (sKey, sValue) values ("{key}", "{value}")')
-
-def sql_query(sql: str) -> list:
-    mydb = mysql.connector.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
-
-    myCursor = mydb.cursor()
-    myCursor.execute(sql)
-    sql = sql.lower().strip()
-
-    if sql.startswith('select'):
-        return myCursor.fetchall()
-    elif sql.startswith('update') or sql.startswith('insert') or sql.startswith('delete'):
-        mydb.commit()
-        return []
+    with db_transaction() as cursor:
+        cursor.execute('delete from settings where sKey = %s', [key])
+        cursor.execute('insert into settings (sKey, sValue) values (%s, %s)', [key, value])
+
+class PooledConnection:
+    def __init__(self, dbName: str):
+        self.dbName = dbName
+        start = time.perf_counter()
+        self.conn = backend.connect(dbName)
+        instrumentation.record(instrumentation.KIND_CONNECT, dbName, time.perf_counter() - start)
+        self.lastUsed = time.monotonic()
+        # sql -> (the same sql object, prepared cursor), the cursor re-prepares unless it gets the identical sql object
+        self.statements: OrderedDict[str, Tuple[str, Any]] = OrderedDict()
+
+    def is_alive(self) -> bool:
+        if time.monotonic() - self.lastUsed < POOL_PING_AFTER:
+            return True
+        try:
+            # no reconnect, the prepared statements would not survive it
+            self.conn.ping(reconnect=False)
+            return True
+        except backend.Error:
+            return False
+
+    def execute_prepared(self, sql: str, params: Sequence) -> Any:
+        if (cached := self.statements.get(sql)) is not None:
+            self.statements.move_to_end(sql)
+        else:
+            cached = (sql, self.conn.cursor(prepared=True))
+            self.statements[sql] = cached
+            if len(self.statements) > PREPARED_CACHE_SIZE:
+                _, (_, evictedCursor) = self.statements.popitem(last=False)
+                evictedCursor.close()
+        preparedSql, cursor = cached
+        cursor.execute(preparedSql, tuple(params))
+        return cursor
+
+    def close(self) -> None:
+        try:
+            self.conn.close()
+        except backend.Error:
+            pass
+
+_pool: Dict[str, List[PooledConnection]] = {}
+_poolLock = threading.Lock()
+
+def _acquire_connection() -> PooledConnection:
+    dbName = DB_NAME
+    while True:
+        with _poolLock:
+            idle = _pool.get(dbName)
+            pooled = idle.pop() if idle else None
+        if pooled is None:
+            return PooledConnection(dbName)
+        if pooled.is_alive():
+            return pooled
+        pooled.close()
+
+def _release_connection(pooled: PooledConnection) -> None:
+    pooled.lastUsed = time.monotonic()
+    with _poolLock:
+        # connections to a database we switched away from are not kept
+        if pooled.dbName == DB_NAME:
+            idle = _pool.setdefault(pooled.dbName, [])
+            if len(idle) < POOL_SIZE:
+                idle.append(pooled)
+                return
+    pooled.close()
+
+def close_connections() -> None:
+    with _poolLock:
+        idle = [pooled for conns in _pool.values() for pooled in conns]
+        _pool.clear()
+    for pooled in idle:
+        pooled.close()
+
+def set_database(dbName: str) -> None:
+    global DB_NAME
+    DB_NAME = dbName
+    close_connections()
+    invalidate_cache()
+
+def set_backend(name: str) -> None:
+    global DB_BACKEND, backend
+    close_connections()
+    DB_BACKEND, backend = name, create_backend(name, DB_HOST, DB_USER, DB_PASSWORD)
+    invalidate_cache()
+
+def is_connection_lost(e: Exception) -> bool:
+    return backend.is_connection_lost(e, CONNECTION_LOST_ERRNOS)
+
+# everything executed through the yielded connection is committed together, or rolled back on error
+@contextmanager
+def db_connection() -> Iterator[PooledConnection]:
+    pooled = _acquire_connection()
+    try:
+        yield pooled
+        pooled.conn.commit()
+    except backend.Error as e:
+        if is_connection_lost(e):
+            pooled.close()
+            raise
+        pooled.conn.rollback()
+        _release_connection(pooled)
+        raise
+    except BaseException:
+        pooled.conn.rollback()
+        _release_connection(pooled)
+        raise
     else:
-        assert False, f"bad sql query: {sql}"
+        _release_connection(pooled)
+
+# statements run through the cursor have their parameters bound on the client side, executemany of an insert is sent
+# as a single multi-row statement
+@contextmanager
+def db_transaction() -> Iterator:
+    start = time.perf_counter()
+    with db_connection() as pooled:
+        cursor = pooled.conn.cursor()
+        if instrumentation.enabled:
+            cursor = instrumentation.TimedCursor(cursor, time.perf_counter() - start)
+        yield cursor
+
+# single statements, executed as cached server side prepared statements
+def sql_query(sql: str, params: Sequence = ()) -> list:
+    sqlLower = sql.lower().strip()
+    isSelect = sqlLower.startswith('select')
+    assert isSelect or sqlLower.startswith(('update', 'insert', 'delete')), f"bad sql query: {sqlLower}"
+
+    # a pooled connection may have been dropped by the server, in that case retry once on a fresh one
+    for attempt in range(2):
+        try:
+            start = time.perf_counter()
+            with db_connection() as pooled:
+                # taking a connection from the pool can mean a ping or a new connection
+                connected = time.perf_counter()
+                cursor = pooled.execute_prepared(sql, params)
+                rows = cursor.fetchall() if isSelect else []
+            if instrumentation.enabled:
+                instrumentation.record_query(sql, time.perf_counter() - start, len(rows) if isSelect else cursor.rowcount, connected - start)
+            return rows
+        except backend.Error as e:
+            if attempt > 0 or not is_connection_lost(e):
+                raise
+    return []
 
 def get_new_id(table: Table) -> int:
     idx = sql_query(f'select max(id) from {table.value}')[0][0]
     assert isinstance(idx, int) or idx is None, f"invalid new id received from table {table.value}"
     return idx + 1 if isinstance(idx, int) else 0
 
+# classifications and signatures change only through the functions below, so they are read from the DB once per process
+# and the cache is updated together with every write
+_classifications: Optional[List[Tuple[int, int, str]]] = None     # (id, type, name)
+_signatures: Optional[List[Tuple[int, int, str]]] = None          # (id, cls_id, value), by id
+_cacheLock = threading.RLock()
+
+def invalidate_cache() -> None:
+    global _classifications, _signatures
+    with _cacheLock:
+        _classifications, _signatures = None, None
+
+def cached_classifications() -> List[Tuple[int, int, str]]:
+    global _classifications
+    with _cacheLock:
+        if _classifications is None:
+            _classifications = [tuple(row) for row in sql_query('select id, type, name from classifications order by id')]
+        return _classifications
+
+def cached_signatures() -> List[Tuple[int, int, str]]:
+    global _signatures
+    with _cacheLock:
+        if _signatures is None:
+            _signatures = [tuple(row) for row in sql_query('select id, cls_id, value from signatures order by id')]
+        return _signatures
+
 def add_new_signature(clsId: int, signature: str) -> int:
-    newId = get_new_id(Table.SIGNATURES)
-    sql_query(f'insert into signatures (id, cls_id, value) values ({newId}, {clsId}, "{signature}")')
+    with _cacheLock:
+        newId = get_new_id(Table.SIGNATURES)
+        sql_query('insert into signatures (id, cls_id, value) values (%s, %s, %s)', [newId, clsId, signature])
+        if _signatures is not None:
+            _signatures.append((newId, clsId, signature))
     return newId
 
 def remove_signature(idx: int) -> None:
-    sql_query(f'delete from signatures where id = {idx}')
+    global _signatures
+    with _cacheLock:
+        sql_query('delete from signatures where id = %s', [idx])
+        if _signatures is not None:
+            _signatures = [sig for sig in _signatures if sig[0] != idx]
 
 def get_signatures_of_cls_type(cls: ClsType) -> list:
-    return sql_query(f'select s.value, c.id from classifications c, signatures s where s.cls_id = c.id and c.type = {cls.value}')
+    clsIds = {c[0] for c in cached_classifications() if c[1] == cls.value}
+    return [(value, clsId) for _, clsId, value in cached_signatures() if clsId in clsIds]
 
 def get_signatures(clsId: int) -> list:
-    return sql_query(f'select id, cls_id, value from signatures where cls_id = {clsId}')
+    return [sig for sig in cached_signatures() if sig[1] == clsId]
 
 def get_classifications(cls: Optional[ClsType] = None) -> list:
-    filters = f'where type = {cls.value}' if cls is not None else ''
-    return sql_query(f'select id, type, name from classifications {filters}')
+    if cls is None:
+        return list(cached_classifications())
+    return [c for c in cached_classifications() if c[1] == cls.value]
 
 def add_new_classification(cls: ClsType, name: str) -> int:
-    newId = get_new_id(Table.CLASSIFICATIONS)
-    sql_query(f'insert into classifications (id, type, name) values ({newId}, {cls.value}, "{name}")')
+    with _cacheLock:
+        newId = get_new_id(Table.CLASSIFICATIONS)
+        sql_query('insert into classifications (id, type, name) values (%s, %s, %s)', [newId, cls.value, name])
+        if _classifications is not None:
+            _classifications.append((newId, cls.value, name))
     return newId
 
-def find_transaction_by_identifier(identifier: str) -> bool:
-    return len(sql_query(f'select id from transactions where transactionIdentifier = "{identifier}"')) > 0
-
-def parse_fields(t: Transaction, fields: List[str]) -> Tuple[str, str]:
-    columnNames: List[str] = []
-    columnValues: List[str] = []
-
-    for field in fields:
-        value = getattr(t, field)
-        if not isinstance(value, int) and not value:
-            continue
-        elif isinstance(value, str):
-            value = value.strip()
-            if not value:
-                continue
-            value = f'"{value}"'
-        elif isinstance(value, date):
-            value = f'"{value}"'
-        else:
-            value = str(value)
-        columnNames.append(field)
-        columnValues.append(value)
+def find_existing_identifiers(identifiers: Iterable[Optional[str]]) -> Set[str]:
+    toCheck = list({identifier for identifier in identifiers if identifier})
+    existing: Set[str] = set()
+    if not toCheck:
+        return existing
 
-    return ','.join(columnNames), ','.join(columnValues)
+    with db_transaction() as cursor:
+        for i in range(0, len(toCheck), LOOKUP_CHUNK_SIZE):
+            chunk = toCheck[i:i + LOOKUP_CHUNK_SIZE]
+            cursor.execute(f'select transactionIdentifier from transactions where transactionIdentifier in ({",".join(["%s"] * len(chunk))})', chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+    return existing
 
 def save_new_transaction(t: Transaction) -> int:
-    assert t.id is None, "transaction already has an id"
-
-    t.id = get_new_id(Table.TRANSACTIONS)
-
-    columnNames, columnValues = parse_fields(t, transactionFieldsSave)
-
-    sql_query(f'insert into transactions ({columnNames}) values ({columnValues})')
-    return t.id
+    return save_new_transactions([t])[0]
+
+def db_value(value):
+    # empty values are stored as null, strings are stripped
+    if isinstance(value, str):
+        value = value.strip()
+        return value if value else None
+    if not isinstance(value, int) and not value:
+        return None
+    return value
 
-def save_modified_transaction(t: Transaction) -> None:
-    updatedColumns = ', '.join([f'{field} = {value_or_null(t, field, commas=False)}' for field in transactionFieldsSave])
-    sql_query(f'update transactions set {updatedColumns} where id = {t.id}')
+def save_new_transactions(transactions: List[Transaction]) -> List[int]:
+    assert all(t.id is None for t in transactions), "transaction already has an id"
+    if not transactions:
+        return []
 
-def get_transactions(filters: str = '') -> list:
+    placeholders = ','.join(['%s'] * len(transactionFieldsSave))
+    insertTransactions = f'insert into transactions ({",".join(transactionFieldsSave)}, modifiedAt) values ({placeholders}, current_timestamp)'
+
+    try:
+        with db_transaction() as cursor:
+            cursor.execute(f'select max(id) from {Table.TRANSACTIONS.value}')
+            maxId = cursor.fetchone()[0]
+            newId = maxId + 1 if isinstance(maxId, int) else 0
+
+            rows: List[tuple] = []
+            tagLinks: List[Tuple[int, int]] = []
+            for t in transactions:
+                t.id = newId
+                newId += 1
+                rows.append(tuple(db_value(getattr(t, field)) for field in transactionFieldsSave))
+                tagLinks.extend((t.id, tagId) for tagId in t.tags)
+
+            # executemany rewrites an insert into a single multi-row statement
+            for i in range(0, len(rows), BULK_INSERT_ROWS):
+                cursor.executemany(insertTransactions, rows[i:i + BULK_INSERT_ROWS])
+            insert_tag_links(cursor, tagLinks)
+            # the new ids are consecutive
+            update_rollups(cursor, 't.id between %s and %s', [transactions[0].id, transactions[-1].id], 1)
+    except Exception:
+        for t in transactions:
+            t.id = None
+        raise
+
+    return [t.id for t in transactions]
+
+# the row and its tag changes are written in one DB transaction, with up to five statements - the rollups of the old row
+# taken out, the row, the removed tags, the added tags and the rollups of the new row put back
+def save_modified_transaction(t: Transaction, addedTags: Set[int], removedTags: Set[int]) -> None:
+    updatedColumns = ', '.join([f'{field} = %s' for field in transactionFieldsSave])
+    with db_transaction() as cursor:
+        update_rollups(cursor, 't.id = %s', [t.id], -1)
+        cursor.execute(f'update transactions set {updatedColumns}, modifiedAt = current_timestamp where id = %s',
+                       [getattr(t, field) for field in transactionFieldsSave] + [t.id])
+        if removedTags:
+            cursor.execute(f'delete from tag_links where trans_id = %s and cls_id in ({",".join(["%s"] * len(removedTags))})', [t.id, *removedTags])
+        insert_tag_links(cursor, [(t.id, tagId) for tagId in addedTags])
+        update_rollups(cursor, 't.id = %s', [t.id], 1)
+
+def insert_tag_links(cursor, tagLinks: List[Tuple[int, int]]) -> None:
+    for i in range(0, len(tagLinks), BULK_INSERT_ROWS):
+        cursor.executemany('insert into tag_links (trans_id, cls_id) values (%s, %s)', tagLinks[i:i + BULK_INSERT_ROWS])
+
+# changed classifications of stored transactions as (id, trType, category, added tags), one DB transaction per batch
+def save_classifications(changes: List[Tuple[int, Optional[int], Optional[int], Tuple[int, ...]]]) -> None:
+    for i in range(0, len(changes), LOOKUP_CHUNK_SIZE):
+        batch = changes[i:i + LOOKUP_CHUNK_SIZE]
+        ids = [change[0] for change in batch]
+        idCondition = f't.id in ({",".join(["%s"] * len(ids))})'
+        with db_transaction() as cursor:
+            update_rollups(cursor, idCondition, ids, -1)
+            backend.update_classifications(cursor, [(trId, trType, category) for trId, trType, category, _ in batch])
+            insert_tag_links(cursor, [(trId, tagId) for trId, _, _, addedTags in batch for tagId in addedTags])
+            update_rollups(cursor, idCondition, ids, 1)
+
+def description_filter(text: str) -> SqlFilter:
+    # every word must be contained in the signature, words are matched as substrings (ngram phrases) in the full-text index
+    # if the backend has one
+    conditions: List[str] = []
+    params: List[Any] = []
+    terms: List[str] = []
+    for word in description_words(text):
+        if backend.fullText and len(word) >= FULLTEXT_MIN_TERM:
+            terms.append(f'+"{word}"')
+        else:
+            conditions.append('t.signature like %s')
+            params.append(f'%{word}%')
+    if terms:
+        conditions.insert(0, 'match(t.signature) against (%s in boolean mode)')
+        params.insert(0, ' '.join(terms))
+    return ' and '.join(conditions), params
+
+# filters as returned by TransactionFilter.to_sql, pages are chained by the (dueDate, id) of the last row of the previous page
+def get_transactions(filters: SqlFilter = ('', []), after: Optional[Tuple[date, int]] = None, limit: Optional[int] = None) -> list:
+    where, params = filters[0], list(filters[1])
+    if after is not None:
+        keyset = '(t.dueDate, t.id) > (%s, %s)'
+        where = f'{where} and {keyset}' if where else f' where {keyset}'
+        params += [after[0], after[1]]
+    if limit is not None:
+        params.append(limit)
     return sql_query(f'''
         select {",".join(["t." + field for field in transactionFieldsSelect])}, group_concat(tl.cls_id)
         from transactions as t left join tag_links as tl on tl.trans_id = t.id
-        {filters}
+        {where}
         group by t.id
         order by t.dueDate, t.id
-    ''')
-
-def get_tags(trId: int) -> list:
-    return sql_query(f'select distinct cls_id from tag_links where trans_id = {trId}')
+        {"limit %s" if limit is not None else ""}
+    ''', params)
+
+def count_transactions() -> int:
+    return sql_query('select count(*) from transactions')[0][0]
+
+# debit, credit and count of the filtered transactions per (type, category)
+def get_transaction_totals(filters: SqlFilter = ('', [])) -> List[Tuple[Optional[int], Optional[int], int, int, int]]:
+    rows = sql_query(f'''
+        select f.trType, f.category, sum(case when f.amount < 0 then f.amount else 0 end), sum(case when f.amount >= 0 then f.amount else 0 end), count(*)
+        from (
+            select t.id, t.amount, t.trType, t.category
+            from transactions as t left join tag_links as tl on tl.trans_id = t.id
+            {filters[0]}
+            group by t.id
+        ) as f
+        group by f.trType, f.category
+    ''', filters[1])
+    return [(trType, category, int(debit), int(credit), cnt) for trType, category, debit, credit, cnt in rows]
 
 def remove_transaction(trId: int) -> None:
-    sql_query(f'delete from tag_links where trans_id = {trId}')
-    sql_query(f'delete from transactions where id = {trId}')
-
-def remove_tags(trId: int, tagIds: Set[int]) -> None:
-    sql_query(f'delete from tag_links where trans_id = {trId} and cls_id in ({",".join(map(str, tagIds))})')
-
-def add_tags(trId: int, tagIds: Set[int]) -> None:
-    for tagId in tagIds:
-        add_tag(trId, tagId)
-
-def add_tag(trId: int, tagId: int) -> None:
-    sql_query(f'insert into tag_links (trans_id, cls_id) values ({trId}, {tagId})')
\ No newline at end of file
+    with db_transaction() as cursor:
+        update_rollups(cursor, 't.id = %s', [trId], -1)
+        cursor.execute('delete from tag_links where trans_id = %s', [trId])
+        cursor.execute('delete from transactions where id = %s', [trId])
+
+# rollups hold sums and counts per month, bank and classification (type, category and tag, dim is the ClsType value),
+# they are updated together with every change of a transaction, within the same DB transaction
+def rollup_select(idCondition: str) -> str:
+    sums = 'sum(case when t.amount < 0 then t.amount else 0 end) as debit, sum(case when t.amount >= 0 then t.amount else 0 end) as credit, count(*) as cnt'
+    period = backend.month_start('t.dueDate')
+    return f'''
+        select {period} as period, {ClsType.TR_TYPE.value} as dim, coalesce(t.trType, {NO_CLS_ID}) as dimKey, t.bank as bank, {sums}
+        from transactions as t where {idCondition} group by period, dimKey, bank
+        union all
+        select {period} as period, {ClsType.CATEGORY.value} as dim, coalesce(t.category, {NO_CLS_ID}) as dimKey, t.bank as bank, {sums}
+        from transactions as t where {idCondition} group by period, dimKey, bank
+        union all
+        select {period} as period, {ClsType.TAG.value} as dim, tl.cls_id as dimKey, t.bank as bank, {sums}
+        from transactions as t join tag_links as tl on tl.trans_id = t.id where {idCondition} group by period, dimKey, bank
+    '''
+
+# adds (sign 1) or subtracts (sign -1) the current state of the selected transactions to/from the rollups
+def update_rollups(cursor, idCondition: str, params: List, sign: int) -> None:
+    cursor.execute(backend.add_to_rollups(
+        f'select r.period, r.dim, r.dimKey, r.bank, {sign} * r.debit, {sign} * r.credit, {sign} * r.cnt from ({rollup_select(idCondition)}) as r'
+    ), params * 3)
+
+def rebuild_rollups() -> None:
+    with db_transaction() as cursor:
+        cursor.execute('delete from rollups')
+        update_rollups(cursor, '1 = 1', [], 1)
+
+# monthly debit, credit and count per classification of the dim type (None for unclassified), from the rollups
+def get_rollups(dim: ClsType, dateFrom: Optional[date] = None, dateTo: Optional[date] = None,
+                bank: Optional[str] = None) -> List[Tuple[date, Optional[int], int, int, int]]:
+    conditions, params = ['dim = %s'], [dim.value]
+    if dateFrom is not None:
+        conditions.append('period >= %s')
+        params.append(dateFrom.replace(day=1))
+    if dateTo is not None:
+        conditions.append('period <= %s')
+        params.append(dateTo)
+    if bank is not None:
+        conditions.append(backend.equals_ignore_case('bank'))
+        params.append(bank)
+
+    with db_transaction() as cursor:
+        cursor.execute(f'''
+            select period, dimKey, sum(debit), sum(credit), sum(cnt) from rollups
+            where {" and ".join(conditions)}
+            group by period, dimKey
+            order by period, dimKey
+        ''', params)
+        rows = cursor.fetchall()
+    return [(period, dimKey if dimKey != NO_CLS_ID else None, int(debit), int(credit), int(cnt)) for period, dimKey, debit, credit, cnt in rows]
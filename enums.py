@@ -16,4 +16,5 @@ class CsvType(Enum):
     MB = 'mb'
 
 class Settings(Enum):
-    LAST_BACKUP = 'last_backup'
\ No newline at end of file
+    LAST_BACKUP = 'last_backup'
+    SCHEMA_VERSION = 'schema_version'
\ No newline at end of file
@@ -0,0 +1,97 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import dbif
+import instrumentation
+from csv_parser import CsvParser, CHUNK_SIZE
+from enums import CsvType, TransactionStatus
+from signatures import signatures
+from transaction import Transaction
+
+@dataclass
+class ImportProgress:
+    filename: str
+    fraction: float = 0.0       # part of the file read so far
+    parsedCnt: int = 0
+    duplicateCnt: int = 0
+    savedCnt: int = 0
+
+# read -> parse -> classify -> mark duplicates -> (save), one chunk at a time so that the memory use does not grow with the file size
+def import_file(filename: str, sourceType: CsvType, save: bool = False, chunkSize: int = CHUNK_SIZE,
+                progress: Optional[Callable[[ImportProgress], None]] = None) -> Iterator[List[Transaction]]:
+    status = ImportProgress(filename)
+    seenIdentifiers: Set[str] = set()
+
+    for chunk, fraction in CsvParser().iter_transactions(filename, sourceType, chunkSize):
+        with instrumentation.timed(instrumentation.KIND_IMPORT, 'classify', len(chunk)):
+            for t in chunk:
+                t.find_classifications()
+        with instrumentation.timed(instrumentation.KIND_IMPORT, 'mark duplicates', len(chunk)):
+            status.duplicateCnt += Transaction.mark_duplicates(chunk, seenIdentifiers)
+
+        if save:
+            toSave = [t for t in chunk if t.status == TransactionStatus.NEW and t.is_complete()]
+            with instrumentation.timed(instrumentation.KIND_IMPORT, 'save', len(toSave)):
+                dbif.save_new_transactions(toSave)
+            for t in toSave:
+                t.mark_saved()
+            status.savedCnt += len(toSave)
+
+        status.parsedCnt += len(chunk)
+        status.fraction = fraction
+        if progress is not None:
+            progress(status)
+        yield chunk
+
+@dataclass
+class BatchImportResult:
+    transactions: List[Transaction] = field(default_factory=list)     # all files merged, ordered by due date
+    errors: Dict[str, str] = field(default_factory=dict)               # file name -> error
+    duplicateCnt: int = 0
+
+def init_worker(signatureSnapshot: Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]) -> None:
+    # the records of a worker would be lost with the process anyway
+    instrumentation.disable()
+    signatures.set_signatures(*signatureSnapshot)
+
+def parse_file(filename: str, sourceType: CsvType) -> List[Transaction]:
+    transactions = [t for chunk, _ in CsvParser().iter_transactions(filename, sourceType) for t in chunk]
+    for t in transactions:
+        t.find_classifications()
+    return transactions
+
+# the pool is started from the worker thread, a forked process would inherit the locks other threads hold at that moment
+# (signatures.lock, the logging locks) and hang on them, so the workers start clean and get the signatures in initargs;
+# the GUI window is created only under the __main__ guard of main.py, which the started workers do not run
+def get_mp_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+# files are parsed and classified in worker processes, duplicates are resolved on the merged result
+def import_files(files: List[Tuple[str, CsvType]], workers: Optional[int] = None,
+                 progress: Optional[Callable[[int, int], None]] = None) -> BatchImportResult:
+    result = BatchImportResult()
+    parsed: Dict[int, List[Transaction]] = {}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_mp_context(), initializer=init_worker,
+                             initargs=(signatures.snapshot(),)) as pool:
+        futures = {pool.submit(parse_file, filename, sourceType): idx for idx, (filename, sourceType) in enumerate(files)}
+        for doneCnt, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            try:
+                parsed[idx] = future.result()
+            except Exception as e:
+                logging.warning(f'Importing {files[idx][0]} failed: {e}')
+                result.errors[files[idx][0]] = str(e)
+            if progress is not None:
+                progress(doneCnt, len(files))
+
+    # sorting is stable, transactions of the same day keep the order of the files and of the lines within them
+    result.transactions = [t for idx in sorted(parsed) for t in parsed[idx]]
+    result.transactions.sort(key=lambda t: t.dueDate)
+    result.duplicateCnt = Transaction.mark_duplicates(result.transactions)
+    return result
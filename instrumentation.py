@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+INSTRUMENT_ENV = 'ACCOUNTING2_INSTRUMENT'      # set to 1 to record from the start
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+LOG_FILE = 'instrumentation.log'                # one JSON object per line
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+SUMMARY_TOP = 10
+SHAPE_MAX_LENGTH = 300                          # longer statement shapes are cut in the log and the summary
+
+KIND_SQL = 'sql'            # dbif.sql_query and the db_transaction cursors, name is the statement shape
+KIND_CONNECT = 'connect'    # a new DB connection, name is the DB
+KIND_EVENT = 'event'        # an event handler of Application.run, name is the event
+KIND_IMPORT = 'import'      # a stage of the CSV import of one chunk, name is the stage
+KIND_JOB = 'job'            # a background job, name is the job
+KINDS = [KIND_SQL, KIND_CONNECT, KIND_EVENT, KIND_IMPORT, KIND_JOB]
+
+# checked by the callers before they measure anything, switched off the instrumentation costs a single test
+enabled = False
+
+@dataclass
+class TimingStats:
+    kind: str
+    name: str
+    count: int = 0
+    total: float = 0.0          # seconds
+    longest: float = 0.0
+    rows: int = 0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, seconds: float, rows: Optional[int]) -> None:
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        self.rows += rows or 0
+
+_stats: Dict[Tuple[str, str], TimingStats] = {}
+_statsLock = threading.Lock()
+_log = logging.getLogger('accounting2.instrumentation')
+_log.propagate = False
+
+def enable(logDir: str = LOG_DIR) -> None:
+    global enabled
+    if not _log.handlers:
+        os.makedirs(logDir, exist_ok=True)
+        handler = RotatingFileHandler(os.path.join(logDir, LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _log.addHandler(handler)
+        _log.setLevel(logging.INFO)
+    enabled = True
+    logging.info(f'instrumentation is recorded to {os.path.join(logDir, LOG_FILE)}')
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+def reset() -> None:
+    with _statsLock:
+        _stats.clear()
+
+def record(kind: str, name: str, seconds: float, rows: Optional[int] = None, **extra: Any) -> None:
+    if not enabled:
+        return
+    with _statsLock:
+        if (stats := _stats.get((kind, name))) is None:
+            stats = _stats[(kind, name)] = TimingStats(kind, name)
+        stats.add(seconds, rows)
+    entry: Dict[str, Any] = {'at': datetime.now().isoformat(timespec='milliseconds'), 'kind': kind, 'name': name[:SHAPE_MAX_LENGTH],
+                             'ms': round(seconds * 1000, 3)}
+    if rows is not None:
+        entry['rows'] = rows
+    entry.update(extra)
+    _log.info(json.dumps(entry, ensure_ascii=False))
+
+@contextmanager
+def timed(kind: str, name: str, rows: Optional[int] = None) -> Iterator[None]:
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, name, time.perf_counter() - start, rows)
+
+# the statement with the parameter lists collapsed, statements that differ only in the number of values are one shape
+IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'(?<![\w.])\d+(?:\.\d+)?\b')
+
+@lru_cache(maxsize=1024)
+def statement_shape(sql: str) -> str:
+    shape = ' '.join(sql.split())
+    shape = IN_LIST.sub('(%s, ...)', shape)
+    shape = STRING_LITERAL.sub('?', shape)
+    return NUMBER_LITERAL.sub('N', shape)
+
+def record_query(sql: str, seconds: float, rows: Optional[int], connectSeconds: float) -> None:
+    record(KIND_SQL, statement_shape(sql), seconds, rows, connectMs=round(connectSeconds * 1000, 3))
+
+# the cursor of dbif.db_transaction while recording - the first statement gets the time of taking the connection,
+# the rows are the ones affected, or for a select what the server reports before fetching (None if unknown)
+class TimedCursor:
+    def __init__(self, cursor: Any, connectSeconds: float):
+        self.cursor = cursor
+        self.connectSeconds = connectSeconds
+
+    def timed_call(self, method: Any, sql: str, params: Any) -> None:
+        start = time.perf_counter()
+        method(sql, params)
+        rowcount = getattr(self.cursor, 'rowcount', -1)
+        record_query(sql, time.perf_counter() - start, rowcount if rowcount is not None and rowcount >= 0 else None, self.connectSeconds)
+        self.connectSeconds = 0.0
+
+    def execute(self, sql: str, params: Any = ()) -> None:
+        self.timed_call(self.cursor.execute, sql, params)
+
+    def executemany(self, sql: str, rows: Any) -> None:
+        self.timed_call(self.cursor.executemany, sql, rows)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.cursor, name)
+
+# the event loop measures a handler from the event to the next read of the window, so the handlers that end with
+# a "continue" are measured as well
+class HandlerTimer:
+    def __init__(self):
+        self.event: Optional[str] = None
+        self.start = 0.0
+
+    def begin(self, event: Any) -> None:
+        if enabled:
+            # table clicks carry the clicked cell, the cell is not a part of the name
+            self.event = '/'.join(map(str, event[:2])) if isinstance(event, tuple) else str(event)
+            self.start = time.perf_counter()
+
+    def end(self) -> None:
+        if self.event is not None:
+            record(KIND_EVENT, self.event, time.perf_counter() - self.start)
+            self.event = None
+
+def top_stats(kind: str, topN: int = SUMMARY_TOP) -> List[TimingStats]:
+    with _statsLock:
+        stats = [s for s in _stats.values() if s.kind == kind]
+    return sorted(stats, key=lambda s: s.total, reverse=True)[:topN]
+
+def summary(topN: int = SUMMARY_TOP) -> str:
+    lines: List[str] = []
+    for kind in KINDS:
+        if not (stats := top_stats(kind, topN)):
+            continue
+        lines.append(f'{kind} - top {len(stats)} by total time')
+        lines.append(f'{"total ms":>10} {"count":>7} {"mean ms":>9} {"max ms":>9} {"rows":>9}  name')
+        for s in stats:
+            lines.append(f'{s.total * 1000:10.1f} {s.count:7d} {s.mean * 1000:9.2f} {s.longest * 1000:9.2f} {s.rows:9d}  {s.name[:SHAPE_MAX_LENGTH]}')
+        lines.append('')
+    return '\n'.join(lines) if lines else 'Nothing recorded yet'
+
+# written when the application ends, the log then has the totals of the session as well
+def log_summary(topN: int = SUMMARY_TOP) -> None:
+    if enabled:
+        _log.info(json.dumps({'at': datetime.now().isoformat(timespec='milliseconds'), 'kind': 'summary', 'text': summary(topN)},
+                             ensure_ascii=False))
@@ -8,7 +8,8 @@ from enums import ClsType
 def get_main_window_layout():
     ##### main table frame ####################################################
     transactionsTable = sg.Table(values = [[]], key='tbl_transactions', headings=['id', 'date', 'amount', 'message', 'type', 'category', 'status'],
-                                 auto_size_columns=False, num_rows=60, col_widths=[5, 12, 10, 100, 20, 20, 10], enable_events = True)
+                                 auto_size_columns=False, num_rows=60, col_widths=[5, 12, 10, 100, 20, 20, 10], enable_events = True,
+                                 enable_click_events=True)
 
     frameButtons = sg.Frame(layout=[
         [sg.Button('Save one', key='btn_save_one', p=((0, 15), (0, 0))),
@@ -17,12 +18,14 @@ def get_main_window_layout():
          sg.Button('Hide line', key='btn_hide_line', p=((0, 15), (0, 0))),
          sg.Button('Remove line from DB', key='btn_remove_line', p=((0, 15), (0, 0))),
          sg.Button('Load from file', key='btn_load_from_file', p=((0, 15), (0, 0))),
-         sg.Button('Recalc classes', key='btn_racalc_classes', p=((0, 40), (0, 0))),
+         sg.Button('Recalc classes', key='btn_racalc_classes', p=((0, 15), (0, 0))),
+         sg.Button('Reclassify history', key='btn_reclassify', p=((0, 40), (0, 0))),
 
          sg.Text('Total credit:'), sg.Text('', key='txt_total_credit', p=((0, 25), (0, 0))),
          sg.Text('Total debit:'), sg.Text('', key='txt_total_debit', p=((0, 25), (0, 0))),
          sg.Text('Total amount:'), sg.Text('', key='txt_total_amount', p=((0, 25), (0, 0))),
-         sg.Text('Transaction count:'), sg.Text('', key='txt_total_cnt')
+         sg.Text('Transaction count:'), sg.Text('', key='txt_total_cnt', p=((0, 25), (0, 0))),
+         sg.Button('Subtotals', key='btn_subtotals')
         ],
         [
             sg.Button('Save all', key='btn_save_all', p=((0, 15), (0, 0))),
@@ -97,7 +100,8 @@ def get_main_window_layout():
         ],
         [HorizontalSeparator(p=((0, 0), (10, 10)))],
         [
-            sg.Button('Load data', key='btn_load_data', p= ((10, 50), (10, 10))),
+            sg.Button('Load data', key='btn_load_data', p= ((10, 10), (10, 10))),
+            sg.Button('Filter loaded', key='btn_filter_loaded', p= ((0, 50), (10, 10))),
             sg.Button('<', key='btn_filter_prev_month'),
             sg.Button('This month', key='btn_filter_this_month'),
             sg.Button('>', key='btn_filter_next_month', p= ((10, 50), (10, 10))),
@@ -111,8 +115,11 @@ def get_main_window_layout():
             sg.Radio('Test DB', 'grp_db', key='radio_db_test', enable_events=True),
             sg.Radio('Real DB', 'grp_db', key='radio_db_real', default=True, enable_events=True)
         ],
-        [sg.Button('Backup DB', key='btn_backup'), sg.Button('Restore DB', key='btn_restore')],
-        [sg.Text('Last backup:'), sg.Text('', key='txt_last_backup', p = ((0, 0), (5, 0)))]
+        [sg.Button('Backup DB', key='btn_backup'), sg.Button('Incremental backup', key='btn_backup_incr'), sg.Button('Restore DB', key='btn_restore')],
+        [sg.Text('Last backup:'), sg.Text('', key='txt_last_backup', p = ((0, 0), (5, 0)))],
+        [sg.Text('', key='txt_job', size=(30, 1))],
+        [sg.ProgressBar(1, orientation='h', size=(20, 15), key='progress_job'), sg.Button('Cancel', key='btn_cancel_job', disabled=True)],
+        [sg.Button('Performance', key='btn_perf_summary')]
     ], title='Options', p=((100, 0), (290, 0)))
 
     return [
@@ -124,4 +131,7 @@ layout = get_main_window_layout()
 window = sg.Window('Welcome to accounting', layout, default_element_size=(12, 1), element_padding=(1, 1), return_keyboard_events=True,
                    resizable=False, finalize=True, location=(80, 0))
                    #resizable=False, finalize=True, size=(2220, 1355))
+# the transaction table is filled page by page as it is scrolled (mouse wheel on windows/mac, buttons 4 and 5 on X11)
+for scrollEvent in ['<MouseWheel>', '<Button-4>', '<Button-5>', '<Next>', '<End>']:
+    window['tbl_transactions'].bind(scrollEvent, '+SCROLL')
 print(f'size: {window.size}')
\ No newline at end of file
@@ -1,49 +1,73 @@
+import copy
 import logging
+import os
+from contextlib import nullcontext
 from datetime import datetime, date, timedelta
 
 import PySimpleGUI as sg
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Callable, Dict, List, Optional, Tuple, Any
 
 import dbif
-from backup import backup_db, restore_db
-from csv_parser import CsvParser
+import instrumentation
+import migrations
+from backup import backup_db, restore_db, BackupManifest, RestoreResult
+from reclassify import reclassify, apply_changes, ReclassifyResult
+from signatures import signatures
+from importer import import_file, import_files, ImportProgress, BatchImportResult
 from enums import ClsType, TransactionStatus, CsvType, Settings
 from layout import window
-from transaction import Transaction
+from transaction import Transaction, TagSet
+from transaction_filter import TransactionFilter
+from transaction_store import TransactionStore, NO_VALUE
+from totals import RunningTotals
 from utils import display_amount
+from worker import BackgroundWorker, Job, WORKER_EVENT
+
+PAGE_SIZE = 500
+PAGE_PREFETCH_AT = 0.9      # the next page is loaded when the table is scrolled past this part of the loaded rows
+PAGE_PREFETCH_ROWS = 20     # or when a row this close to the end of the loaded rows is selected
 
 
 # TODOs
 #   when adding tag, allow fulltext search
 #   disable backup and restore for test DB
-#   put sql_query into a try-except block
 #   add a note field to transactions
 #   save all button, misc purchase button
-#   detect duplicates
 #   one signature for category and several tags
 
 class Application:
     def __init__(self):
-        allClassifications = dbif.get_classifications()
-        self.clsIdToName: Dict[Optional[int], str] = {c[0]: c[2] for c in allClassifications}
-        self.clsIdToName[None] = 'unknown'
-
-        self.signNameToId: Dict[str, int] = {}
+        migrations.migrate()
 
+        self.clsIdToName: Dict[Optional[int], str] = {}
+        self.clsIdToType: Dict[int, ClsType] = {}
         self.clsNameToId: Dict[Tuple[ClsType, str], int] = {}
-        for id, clsType, name in allClassifications:
-            self.clsNameToId[(ClsType(clsType), name)] = id
-
-        self.csvParser = CsvParser()
+        self.signNameToId: Dict[str, int] = {}
 
-        self.transactions: List[Transaction] = []
+        self.store = TransactionStore()
+        self.transactions: List[Transaction] = []     # the rows shown in the table, a subset of the store
+        self.totals = RunningTotals()                  # of the shown rows
+        self.pageFilters: Optional[dbif.SqlFilter] = None         # filters of the shown DB result while more pages can be loaded
+        self.lastPageKey: Optional[Tuple[date, int]] = None
+        self.allPagesLoaded = True
+        self.sortColumn: Optional[int] = None
         self.window = window
+        self.worker = BackgroundWorker(window)
         self.values: Any = None
         self.event: Any = None
 
-        self.refresh_cls_filters()
+        self.load_classifications()
         self.refresh_last_backup()
 
+    # classifications come from the dbif cache, only the first call after start or a DB switch reads the DB
+    def load_classifications(self) -> None:
+        allClassifications = dbif.get_classifications()
+        self.clsIdToName = {c[0]: c[2] for c in allClassifications}
+        self.clsIdToName[None] = 'unknown'
+        self.clsNameToId = {(ClsType(clsType), name): id for id, clsType, name in allClassifications}
+        self.clsIdToType = {id: ClsType(clsType) for id, clsType, _ in allClassifications}
+        self.refresh_cls_filters()
+
     def refresh_cls_filters(self):
         tr_types = list(map(lambda t: t[2], dbif.get_classifications(ClsType.TR_TYPE)))
         categories = list(map(lambda t: t[2], dbif.get_classifications(ClsType.CATEGORY)))
@@ -72,7 +96,7 @@ class Application:
         if lastBkp is None:
             lastBkp = 'never'
             textColor = 'red'
-        elif datetime.now() - datetime.strptime(lastBkp, '%Y-%m-%d') > timedelta(days=90):
+        elif datetime.now() - datetime.strptime(lastBkp[:10], '%Y-%m-%d') > timedelta(days=90):
             textColor = 'red'
         self.window['txt_last_backup'].update(lastBkp, text_color=textColor)
 
@@ -84,66 +108,57 @@ class Application:
         self.window['radio_filter_both'].update(True)
         self.window['radio_filter_bank_all'].update(True)
 
-    def get_filters(self) -> Optional[str]:
-        filters: List[str] = []
+    def get_filter(self) -> Optional[TransactionFilter]:
+        flt = TransactionFilter()
 
         if dateFrom := self.window['filter_date_from'].get():
             try:
-                datetime.strptime(dateFrom, '%Y-%m-%d')
+                flt.dateFrom = datetime.strptime(dateFrom, '%Y-%m-%d').date()
             except ValueError:
                 sg.popup(f'Invalid date format in start date: {dateFrom}', title='Error')
                 return None
-            filters.append(f't.dueDate >= "{dateFrom}"')
 
         if dateTo := self.window['filter_date_to'].get():
             try:
-                datetime.strptime(dateTo, '%Y-%m-%d')
+                flt.dateTo = datetime.strptime(dateTo, '%Y-%m-%d').date()
             except ValueError:
                 sg.popup(f'Invalid date format in end date: {dateTo}', title='Error')
                 return None
-            filters.append(f't.dueDate <= "{dateTo}"')
 
         if amountMin := self.values['filter_amount_min']:
             try:
-                if int(amountMin) < 0:
+                flt.amountMin = int(amountMin)
+                if flt.amountMin < 0:
                     raise ValueError
             except ValueError:
                 sg.popup(f'Invalid minimum amount: {amountMin}', title='Error')
                 return None
-            filters.append(f'abs(t.amount) >= 100 * {amountMin}')
 
         if amountMax := self.values['filter_amount_max']:
             try:
-                if int(amountMax) < 0:
+                flt.amountMax = int(amountMax)
+                if flt.amountMax < 0:
                     raise ValueError
-            except ValueError as e:
+            except ValueError:
                 sg.popup(f'Invalid maximum amount: {amountMax}', title='Error')
                 return None
-            filters.append(f'abs(t.amount) <= 100 * {amountMax}')
 
-        if self.values['filter_desc']:
-            filters.append(f't.signature like "%{self.values["filter_desc"]}%"')
+        flt.description = self.values['filter_desc']
         if self.values['radio_filter_cred']:
-            filters.append(f't.amount >= 0')
+            flt.credit = True
         if self.values['radio_filter_deb']:
-            filters.append(f't.amount < 0')
+            flt.credit = False
 
         if self.values['radio_filter_bank_kb']:
-            filters.append(f't.bank = "kb"')
+            flt.bank = 'kb'
         if self.values['radio_filter_bank_mb']:
-            filters.append(f't.bank = "mb"')
+            flt.bank = 'mb'
 
-        if self.values['filter_type']:
-            idLst = list(map(lambda t: self.clsNameToId[ClsType.TR_TYPE, t], self.values["filter_type"]))
-            filters.append(f't.trType in ({",".join(map(str, idLst))})')
-        if self.values['filter_category']:
-            idLst = list(map(lambda t: self.clsNameToId[ClsType.CATEGORY, t], self.values["filter_category"]))
-            filters.append(f't.category in ({",".join(map(str, idLst))})')
-        if self.values['filter_tags']:
-            idLst = list(map(lambda t: self.clsNameToId[ClsType.TAG, t], self.values["filter_tags"]))
-            filters.append(f'tl.cls_id in ({",".join(map(str, idLst))})')
+        flt.trTypes = [self.clsNameToId[ClsType.TR_TYPE, t] for t in self.values['filter_type']]
+        flt.categories = [self.clsNameToId[ClsType.CATEGORY, t] for t in self.values['filter_category']]
+        flt.tags = [self.clsNameToId[ClsType.TAG, t] for t in self.values['filter_tags']]
 
-        return f' where {" and ".join(filters)}' if filters else ''
+        return flt
 
     def get_cls_name(self, clsId: Optional[int]) -> str:
         try:
@@ -161,17 +176,25 @@ class Application:
 
         return [transaction.id, transaction.dueDate, display_amount(transaction.amount), description, trTypeName, categoryName, transaction.status.value]
 
-    def recalculate_summaries(self) -> None:
-        sumDebit, sumCredit = 0, 0
-        for t in self.transactions:
-            if t.amount < 0:
-                sumDebit += t.amount
-            else:
-                sumCredit += t.amount
-        self.window['txt_total_debit'].update(display_amount(sumDebit))
-        self.window['txt_total_credit'].update(display_amount(sumCredit))
-        self.window['txt_total_amount'].update(display_amount(sumCredit + sumDebit))
-        self.window['txt_total_cnt'].update(len(self.transactions))
+    def refresh_summaries(self) -> None:
+        self.window['txt_total_debit'].update(display_amount(self.totals.debit))
+        self.window['txt_total_credit'].update(display_amount(self.totals.credit))
+        self.window['txt_total_amount'].update(display_amount(self.totals.total))
+        self.window['txt_total_cnt'].update(self.totals.count)
+
+    def show_subtotals(self) -> None:
+        lines = ['Types:']
+        lines += [f'    {self.get_cls_name(clsId)}: {display_amount(amount)}' for clsId, amount in self.totals.byTrType.items() if amount]
+        lines += ['Categories:']
+        lines += [f'    {self.get_cls_name(clsId)}: {display_amount(amount)}' for clsId, amount in self.totals.byCategory.items() if amount]
+        sg.popup('\n'.join(lines), title='Subtotals')
+
+    # shows the given rows of the store, the totals are computed from the store columns
+    def show_rows(self, rows: List[int]) -> None:
+        self.transactions = self.store.get_transactions(rows)
+        self.totals = RunningTotals.from_store(self.store, rows)
+        # the shown rows are no longer the plain DB result, further pages cannot be appended
+        self.pageFilters = None
 
     def reload_transaction_table(self, reloadFromDB: bool=True) -> None:
         # if a transaction is selected, remember that row to select it (or the previous one, if deleting) afterward
@@ -180,13 +203,13 @@ class Application:
             lineSelected = self.values['tbl_transactions'][0]
 
         if reloadFromDB:
-            filters = self.get_filters()
-            if filters is None:
-                return
-            self.transactions = [Transaction(*t) for t in dbif.get_transactions(filters)]
+            # the table is shown again once the first page arrives
+            if (flt := self.get_filter()) is not None:
+                self.load_first_page(flt.to_sql())
+            return
         self.window['tbl_transactions'].update(values=[self.transaction_to_table_row(t) for t in self.transactions])
 
-        self.recalculate_summaries()
+        self.refresh_summaries()
 
         # now select the same (or neighboring) row as before
         if lineSelected is not None:
@@ -195,6 +218,56 @@ class Application:
             if lineSelected >= 0:
                 self.window['tbl_transactions'].update(select_rows=[lineSelected])
 
+    # only the first page is loaded from the DB, next ones are loaded as the table is scrolled down, totals cover all pages
+    def load_first_page(self, filters: dbif.SqlFilter) -> None:
+        def fetch(job: Job) -> Tuple[list, TransactionStore, RunningTotals]:
+            rows = dbif.get_transactions(filters, limit=PAGE_SIZE)
+            job.check_cancelled()
+            return rows, TransactionStore(Transaction(*t) for t in rows), RunningTotals.from_aggregates(dbif.get_transaction_totals(filters))
+
+        def show(result: Tuple[list, TransactionStore, RunningTotals]) -> None:
+            rows, self.store, self.totals = result
+            self.transactions = list(self.store.transactions)
+            self.pageFilters = filters
+            self.lastPageKey = (rows[-1][1], rows[-1][0]) if rows else None
+            self.allPagesLoaded = len(rows) < PAGE_SIZE
+            self.reload_transaction_table(reloadFromDB=False)
+
+        self.worker.start('Loading transactions', fetch, onDone=show)
+
+    def load_next_page(self) -> None:
+        # the next page is requested again by the next scroll
+        if self.allPagesLoaded or self.pageFilters is None or self.worker.busy:
+            return
+        filters, after = self.pageFilters, self.lastPageKey
+
+        def fetch(job: Job) -> Tuple[list, List[Transaction]]:
+            rows = dbif.get_transactions(filters, after=after, limit=PAGE_SIZE)
+            return rows, [Transaction(*t) for t in rows]
+
+        def show(result: Tuple[list, List[Transaction]]) -> None:
+            rows, page = result
+            # the shown rows changed while the page was loading
+            if self.pageFilters is not filters:
+                return
+            self.allPagesLoaded = len(rows) < PAGE_SIZE
+            if not rows:
+                return
+            self.lastPageKey = (rows[-1][1], rows[-1][0])
+            self.store.extend(page)
+            self.transactions.extend(page)
+
+            # updating the table scrolls it to the top, keep the position
+            scrollPosition = self.window['tbl_transactions'].Widget.yview()[0]
+            self.reload_transaction_table(reloadFromDB=False)
+            self.window['tbl_transactions'].Widget.yview_moveto(scrollPosition)
+
+        self.worker.start('Loading next page', fetch, onDone=show)
+
+    def table_scrolled(self) -> None:
+        if self.window['tbl_transactions'].Widget.yview()[1] >= PAGE_PREFETCH_AT:
+            self.load_next_page()
+
     def clear_signatures_table(self) -> None:
         self.window['tbl_signatures'].update(values=[])
 
@@ -256,12 +329,12 @@ class Application:
         typeId = values['cls'][0]
         newType = self.clsNameToId[(cls, typeId)]
 
-        if cls == ClsType.TR_TYPE:
-            transactionSelected.trType = newType
-        else:
-            transactionSelected.category = newType
-        if transactionSelected.status == TransactionStatus.SAVED:
-            transactionSelected.status = TransactionStatus.MODIFIED
+        with self.totals.changing(transactionSelected):
+            if cls == ClsType.TR_TYPE:
+                transactionSelected.trType = newType
+            else:
+                transactionSelected.category = newType
+        self.mark_modified(transactionSelected)
 
         self.reload_transaction_table(reloadFromDB=False)
 
@@ -285,6 +358,7 @@ class Application:
             tagValue = values['new_tag']
             tagId = dbif.add_new_classification(ClsType.TAG, tagValue)
             self.clsIdToName[tagId] = tagValue
+            self.clsIdToType[tagId] = ClsType.TAG
             self.clsNameToId[(ClsType.TAG, tagValue)] = tagId
             self.window['filter_tags'].update(values=sorted(list(map(lambda t: t[2], dbif.get_classifications(ClsType.TAG)))))
         elif len(values['existing_tag']) > 0:
@@ -294,8 +368,180 @@ class Application:
             return
 
         transactionSelected.tags.add(tagId)
-        if transactionSelected.status == TransactionStatus.SAVED:
-            transactionSelected.status = TransactionStatus.MODIFIED
+        self.mark_modified(transactionSelected)
+        self.reload_transaction_table(reloadFromDB=False)
+
+    def load_from_file(self, filename: str, sourceType: CsvType) -> None:
+        def parse(job: Job) -> None:
+            def report(progress: ImportProgress) -> None:
+                job.progress(int(100 * progress.fraction), 100, f'{progress.parsedCnt} transactions, {progress.duplicateCnt} duplicates')
+            # the table shows the rows as soon as the first chunk is processed
+            for chunk in import_file(filename, sourceType, progress=report):
+                job.publish(chunk)
+
+        def show_chunk(chunk: List[Transaction]) -> None:
+            self.store.extend(chunk)
+            self.transactions.extend(chunk)
+            for t in chunk:
+                self.totals.add(t)
+            self.reload_transaction_table(reloadFromDB=False)
+
+        def failed(e: Exception) -> None:
+            if isinstance(e, FileNotFoundError):
+                sg.popup(f'File {filename} not found', title='Error')
+            else:
+                sg.popup(f'Loading {filename} failed: {e}', title='Error')
+
+        if not self.worker.ensure_idle():
+            return
+        self.store = TransactionStore()
+        self.show_rows([])
+        self.worker.start(f'Loading {filename}', parse, onPartial=show_chunk, onFailed=failed)
+
+    def load_from_files(self, filenames: List[str], sourceType: CsvType) -> None:
+        def parse(job: Job) -> BatchImportResult:
+            return import_files([(filename, sourceType) for filename in filenames],
+                                progress=lambda doneCnt, totalCnt: job.progress(doneCnt, totalCnt, f'{doneCnt} of {totalCnt} files processed'))
+
+        def show(result: BatchImportResult) -> None:
+            self.store = TransactionStore(result.transactions)
+            self.show_rows(list(range(len(self.store))))
+            self.reload_transaction_table(reloadFromDB=False)
+            if result.errors:
+                sg.popup('\n'.join(f'{filename}: {error}' for filename, error in result.errors.items()), title='Some files failed')
+
+        self.worker.start('Loading files', parse, onDone=show)
+
+    def mark_modified(self, t: Transaction) -> None:
+        if t.status == TransactionStatus.SAVED:
+            t.status = TransactionStatus.MODIFIED
+        self.store.update(t)
+
+    # after a signature was added or removed, only the loaded rows containing it can change their classification
+    # changeSignatures adds or removes the signature in the matcher, the affected rows are matched before and after it so
+    # that only the values that came from the signatures change
+    def rematch_signature(self, clsId: int, signature: str, changeSignatures: Callable[[], None]) -> None:
+        clsType = self.clsIdToType[clsId]
+        shown = {id(t) for t in self.transactions}
+        affected = self.store.get_transactions(self.store.rows_containing(signature))
+        matchedBefore = [signatures.match(t.signature) for t in affected]
+        changeSignatures()
+        changedCnt = 0
+        for t, matched in zip(affected, matchedBefore):
+            with self.totals.changing(t) if id(t) in shown else nullcontext():
+                changed = t.rematch(clsType, clsId, matched)
+            if changed:
+                self.mark_modified(t)
+                changedCnt += 1
+        if changedCnt:
+            logging.info(f'{changedCnt} loaded transactions re-classified by signature "{signature}"')
+            self.reload_transaction_table(reloadFromDB=False)
+
+    def show_performance_summary(self) -> None:
+        if not instrumentation.enabled:
+            if sg.popup_yes_no('Query and event timing is off. Start recording now?', title='Performance') == 'Yes':
+                instrumentation.enable()
+            return
+        sg.popup_scrolled(instrumentation.summary(), title='Slowest queries and handlers', size=(140, 40), font='Courier 9')
+
+    # the stored history is checked first, nothing is written until the user confirms the summary
+    def reclassify_history(self) -> None:
+        def check(job: Job) -> ReclassifyResult:
+            return reclassify(dryRun=True, progress=lambda doneCnt, totalCnt: job.progress(doneCnt, totalCnt, f'{doneCnt} of {totalCnt} checked'))
+
+        def confirm(result: ReclassifyResult) -> None:
+            if not result.changes:
+                sg.popup(result.summary(), title='Reclassify history')
+                return
+            if sg.popup_ok_cancel(f'{result.summary()}\nApply the changes?', title='Reclassify history') != 'OK':
+                return
+            # not cancellable, the batches are written to the DB selected at the time, which must not change meanwhile
+            self.worker.start('Applying classifications', lambda job: apply_changes(result), onDone=lambda _: applied(result), cancellable=False)
+
+        def applied(result: ReclassifyResult) -> None:
+            self.reload_transaction_table()
+            sg.popup(result.summary(), title='Success')
+
+        self.worker.start('Reclassifying history', check, onDone=confirm)
+
+    def save_all(self) -> None:
+        toSave = [t for t in self.transactions if t.status == TransactionStatus.NEW and t.is_complete()]
+        notSavedCnt = sum(1 for t in self.transactions if t.status == TransactionStatus.NEW and not t.is_complete())
+
+        # the worker saves copies taken now, the shown rows can be edited while the save runs
+        written = [copy.copy(t) for t in toSave]
+        for w in written:
+            w.tags = TagSet(w.tags)
+
+        def saved(_) -> None:
+            for t, w in zip(toSave, written):
+                t.id = w.id
+                t.mark_saved(w.tags)
+                # changed while the save ran, the change is not in the DB yet
+                if (t.trType, t.category, set(t.tags)) != (w.trType, w.category, set(w.tags)):
+                    t.status = TransactionStatus.MODIFIED
+                self.store.update(t)
+            self.reload_transaction_table(reloadFromDB=False)
+            sg.popup(f'Saved successfully: {len(toSave)}, not saved: {notSavedCnt}', title='Save all')
+
+        # not cancellable, once the rows are committed they must be marked saved
+        self.worker.start('Saving transactions', lambda job: dbif.save_new_transactions(written), onDone=saved, cancellable=False)
+
+    def backup(self, incremental: bool) -> None:
+        def dump(job: Job) -> BackupManifest:
+            return backup_db(incremental, progress=lambda dumped: job.progress(0, 0, f'{dumped / 1e6:.1f} MB dumped'))
+
+        def done(manifest: BackupManifest) -> None:
+            self.refresh_last_backup()
+            sg.popup(f'Backup successful ({manifest.mode}, {manifest.size / 1e6:.1f} MB)\n{manifest.file}', title='Success')
+
+        self.worker.start('Backing up the DB', dump, onDone=done)
+
+    def restore(self, filename: str) -> None:
+        def load(job: Job) -> RestoreResult:
+            return restore_db(filename, progress=lambda fraction: job.progress(int(1000 * fraction), 1000, f'{100 * fraction:.0f} % restored'),
+                              onSwap=job.end_cancellable)
+
+        def done(result: RestoreResult) -> None:
+            # the restored DB has its own classifications and signatures
+            self.load_classifications()
+            Transaction.reload_signatures()
+            self.reload_transaction_table()
+            self.refresh_last_backup()
+            sg.popup(f'Restore successful ({result.mode})', result.summary(), title='Success')
+
+        def failed(e: Exception) -> None:
+            sg.popup(f'Restore failed, the DB was left as it was: {e}', title='Error')
+
+        self.worker.start('Restoring the DB', load, onDone=done, onFailed=failed)
+
+    def filter_loaded(self) -> None:
+        if (flt := self.get_filter()) is None:
+            return
+        self.show_rows(self.store.select(flt))
+        self.reload_transaction_table(reloadFromDB=False)
+
+    def sort_by_column(self, column: int) -> None:
+        # a second click on the same column reverses the order
+        reverse = self.sortColumn == column
+        self.sortColumn = None if reverse else column
+        rows = self.store.rows_of(self.transactions)
+        if column == 0:
+            rows = self.store.sort(rows, 'ids', reverse)
+        elif column == 1:
+            rows = self.store.sort(rows, 'dueDates', reverse)
+        elif column == 2:
+            rows = self.store.sort(rows, 'amounts', reverse)
+        elif column == 4:
+            rows = self.store.sort(rows, 'trTypes', reverse, keyMap=lambda clsId: self.get_cls_name(clsId if clsId != NO_VALUE else None))
+        elif column == 5:
+            rows = self.store.sort(rows, 'categories', reverse, keyMap=lambda clsId: self.get_cls_name(clsId if clsId != NO_VALUE else None))
+        elif column == 6:
+            rows = self.store.sort(rows, 'statuses', reverse)
+        else:
+            return
+        self.transactions = self.store.get_transactions(rows)
+        self.pageFilters = None
         self.reload_transaction_table(reloadFromDB=False)
 
     def get_selected_transaction(self) -> Optional[Transaction]:
@@ -310,32 +556,53 @@ class Application:
         return self.values['tbl_transactions'][0]
 
     def run(self) -> None:
+        handlerTimer = instrumentation.HandlerTimer()
         while True:
+            handlerTimer.end()
             self.event, self.values = self.window.read()
+            handlerTimer.begin(self.event)
 
             #print(f'event: {self.event}\nvalues: {self.values}')
 
             if self.event in (None, 'exit'):
+                instrumentation.log_summary()
                 break
             elif self.event == 'btn_load_data':
                 self.reload_transaction_table()
+            elif self.event == 'btn_filter_loaded':
+                self.filter_loaded()
+            elif self.event == 'btn_subtotals':
+                self.show_subtotals()
+            elif isinstance(self.event, tuple) and self.event[:2] == ('tbl_transactions', '+CLICKED+'):
+                row, column = self.event[2]
+                if row == -1 and column is not None:
+                    self.sort_by_column(column)
             elif self.event == 'tbl_transactions':
                 if (transactionSelected := self.get_selected_transaction()) is None:
                     self.clear_details()
                     continue
 
                 self.show_details(transactionSelected)
+                if self.values['tbl_transactions'][0] >= len(self.transactions) - PAGE_PREFETCH_ROWS:
+                    self.load_next_page()
+
+            elif self.event == 'tbl_transactions+SCROLL':
+                self.table_scrolled()
 
             elif self.event == 'btn_remove_line':
-                if (transactionSelected := self.get_selected_transaction()) is None:
+                if (lineNo := self.get_selected_line_no()) is None:
                     sg.popup('No transaction selected', title='Error')
                     continue
 
                 if sg.popup_ok_cancel('This will remove the transaction permanently. You sure?', title='Careful!') != 'OK':
                     continue
 
-                transactionSelected.delete()
-                self.reload_transaction_table()
+                # the row leaves the table here, a reload from the DB would have to wait for a running job
+                self.transactions[lineNo].delete()
+                transactionRemoved = self.transactions.pop(lineNo)
+                self.store.remove(transactionRemoved)
+                self.totals.remove(transactionRemoved)
+                self.reload_transaction_table(reloadFromDB=False)
 
             elif self.event == 'btn_change_type':
                 self.change_transaction_classification(ClsType.TR_TYPE)
@@ -359,11 +626,9 @@ class Application:
                 tagName = window['tbl_detail_tags'].get()[lineNo][0]
                 tagId = self.clsNameToId[(ClsType.TAG, tagName)]
 
-                assert isinstance(transactionSelected.tags, set), "transaction tags are in a wrong format"
+                assert isinstance(transactionSelected.tags, TagSet), "transaction tags are in a wrong format"
                 transactionSelected.tags.remove(tagId)
-
-                if transactionSelected.status == TransactionStatus.SAVED:
-                    transactionSelected.status = TransactionStatus.MODIFIED
+                self.mark_modified(transactionSelected)
                 self.reload_transaction_table(reloadFromDB=False)
 
             elif self.event == 'btn_save_one':
@@ -375,8 +640,12 @@ class Application:
                     if sg.popup_ok_cancel('Transaction identifier already exists in the DB. You sure you want to save it anyway?', title='Careful!') != 'OK':
                         continue
 
+                # a new row may be in a running "Save all"
+                if transactionSelected.id is None and not self.worker.ensure_idle():
+                    continue
+
                 transactionSelected.save()
-                transactionSelected.status = TransactionStatus.SAVED
+                self.store.update(transactionSelected)
                 self.reload_transaction_table(reloadFromDB=False)
                 # select next line
                 if (lineNo := self.get_selected_line_no()) is not None:
@@ -388,12 +657,14 @@ class Application:
                     sg.popup('No transaction selected', title='Error')
                     continue
 
-                self.transactions.pop(lineNo)
+                transactionHidden = self.transactions.pop(lineNo)
+                self.store.remove(transactionHidden)
+                self.totals.remove(transactionHidden)
                 self.reload_transaction_table(reloadFromDB=False)
             elif self.event == 'btn_load_from_file':
                 event, values = sg.Window('Get file', [
                     [sg.Text('Data file')],
-                    [sg.Input(key='txt_csv_file'), sg.FileBrowse(initial_folder='/home/honza/projects/accounting2/data')],
+                    [sg.Input(key='txt_csv_file'), sg.FilesBrowse(initial_folder='/home/honza/projects/accounting2/data')],
                     [sg.Text('Source')],
                     [sg.Listbox(values=['kb', 'mb'], size=(30, 3), key='lst_source_type')], [sg.OK(), sg.Cancel()]
                 ]).read(close=True)
@@ -407,14 +678,12 @@ class Application:
                     sg.popup('No source selected', title='Error')
                     continue
 
-                filename = values['txt_csv_file']
+                filenames = values['txt_csv_file'].split(';')
                 sourceType = CsvType(values['lst_source_type'][0])
-                self.transactions = self.csvParser.read_transactions(filename, sourceType)
-                for t in self.transactions:
-                    t.find_classifications()
-                    if t.is_duplicate():
-                        t.status = TransactionStatus.DUPLICATE
-                self.reload_transaction_table(reloadFromDB=False)
+                if len(filenames) == 1:
+                    self.load_from_file(filenames[0], sourceType)
+                else:
+                    self.load_from_files(filenames, sourceType)
 
             elif self.event == 'radio_sig_type':
                 transactionSelected = self.get_selected_transaction()
@@ -450,6 +719,9 @@ class Application:
                 self.reload_signature_table(tagId)
 
             elif self.event == 'btn_add_sign':
+                # a running import or reclassification would keep the rows it classified with the old signatures
+                if not self.worker.ensure_idle():
+                    continue
                 if not (clsId := self.get_selected_cls_details()):
                     continue
 
@@ -475,9 +747,11 @@ class Application:
 
                 dbif.add_new_signature(clsId, signature)
                 self.reload_signature_table(clsId)
-                Transaction.reload_signatures()
+                self.rematch_signature(clsId, signature, lambda: signatures.add(self.clsIdToType[clsId], signature, clsId))
 
             elif self.event == 'btn_remove_sign':
+                if not self.worker.ensure_idle():
+                    continue
                 if not (clsId := self.get_selected_cls_details()):
                     continue
 
@@ -494,17 +768,13 @@ class Application:
                     continue
                 dbif.remove_signature(sigId)
                 self.reload_signature_table(clsId)
-                Transaction.reload_signatures()
+                self.rematch_signature(clsId, sigName, lambda: signatures.remove(self.clsIdToType[clsId], sigName, clsId))
 
-            elif self.event == 'btn_backup':
-                retval = backup_db()
-                if retval == 0:
-                    dbif.set_setting(Settings.LAST_BACKUP.value, str(date.today()))
-                    self.refresh_last_backup()
-                    sg.popup('Backup successful', title='Success')
-                else:
-                    sg.popup(f'Backup failed with error code {retval}', title='Error')
+            elif self.event in ('btn_backup', 'btn_backup_incr'):
+                self.backup(incremental=self.event == 'btn_backup_incr')
             elif self.event == 'btn_restore':
+                if not self.worker.ensure_idle():
+                    continue
                 if sg.popup_ok_cancel('This will remove al data from the DB and replace them with the data from the backup. You sure?', title='Careful!') != 'OK':
                     continue
 
@@ -521,13 +791,7 @@ class Application:
                     continue
 
                 filename = values['txt_csv_file']
-                retval = restore_db(filename)
-                if retval == 0:
-                    self.reload_transaction_table()
-                    self.refresh_last_backup()
-                    sg.popup('Restore successful', title='Success')
-                else:
-                    sg.popup(f'Restore failed with error code {retval}', title='Error')
+                self.restore(filename)
 
             elif self.event == 'btn_filter_this_month':
                 firstDayInMonth = date.today().replace(day=1)
@@ -565,15 +829,25 @@ class Application:
                 self.clear_filters()
 
             elif self.event == 'radio_db_test':
-                dbif.DB_NAME = dbif.DB_NAME_TEST
-                self.transactions = []
+                # a result of the other DB must not end up in the table
+                if not self.worker.cancel():
+                    self.window['radio_db_real'].update(value=True)
+                    continue
+                dbif.set_database(dbif.DB_NAME_TEST)
+                self.store = TransactionStore()
+                self.show_rows([])
                 self.reload_transaction_table(reloadFromDB=False)
                 self.__init__()
                 Transaction.reload_signatures()
 
             elif self.event == 'radio_db_real':
-                dbif.DB_NAME = dbif.DB_NAME_REAL
-                self.transactions = []
+                # a result of the other DB must not end up in the table
+                if not self.worker.cancel():
+                    self.window['radio_db_test'].update(value=True)
+                    continue
+                dbif.set_database(dbif.DB_NAME_REAL)
+                self.store = TransactionStore()
+                self.show_rows([])
                 self.reload_transaction_table(reloadFromDB=False)
                 self.__init__()
                 Transaction.reload_signatures()
@@ -582,24 +856,25 @@ class Application:
                 if (transactionSelected := self.get_selected_transaction()) is None:
                     sg.popup('No transaction selected', title='Error')
                     continue
-                transactionSelected.find_classifications()
-                if transactionSelected.status == TransactionStatus.SAVED:
-                    transactionSelected.status = TransactionStatus.MODIFIED
+                with self.totals.changing(transactionSelected):
+                    transactionSelected.find_classifications()
+                self.mark_modified(transactionSelected)
 
                 self.reload_transaction_table(reloadFromDB=False)
 
+            elif self.event == WORKER_EVENT:
+                self.worker.handle_event(self.values[WORKER_EVENT])
+            elif self.event == 'btn_cancel_job':
+                self.worker.cancel()
+
+            elif self.event == 'btn_reclassify':
+                self.reclassify_history()
+
+            elif self.event == 'btn_perf_summary':
+                self.show_performance_summary()
+
             elif self.event == 'btn_save_all':
-                savedCnt, notSavedCnt = 0, 0
-                for t in self.transactions:
-                    if t.status == TransactionStatus.NEW:
-                        if t.trType is not None and t.category is not None:
-                            t.save()
-                            t.status = TransactionStatus.SAVED
-                            savedCnt += 1
-                        else:
-                            notSavedCnt += 1
-                self.reload_transaction_table(reloadFromDB=False)
-                sg.popup(f'Saved successfully: {savedCnt}, not saved: {notSavedCnt}', title='Save all')
+                self.save_all()
 
             elif self.event == 'btn_misc_purchase':
                 if (transactionSelected := self.get_selected_transaction()) is None:
@@ -613,11 +888,13 @@ class Application:
                     sg.popup('misc purchase category not found', title='Error')
                     continue
 
-                transactionSelected.category = newType
-                if transactionSelected.status == TransactionStatus.SAVED:
-                    transactionSelected.status = TransactionStatus.MODIFIED
+                with self.totals.changing(transactionSelected):
+                    transactionSelected.category = newType
+                self.mark_modified(transactionSelected)
 
                 self.reload_transaction_table(reloadFromDB=False)
 
 if __name__ == '__main__':
+    if os.environ.get(instrumentation.INSTRUMENT_ENV):
+        instrumentation.enable()
     Application().run()
@@ -0,0 +1,52 @@
+from collections import deque
+from typing import Dict, List, Set, Tuple
+
+# Aho-Corasick automaton - finds all patterns occurring in a text in a single pass over the text
+class PatternMatcher:
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Tuple[int, ...]] = [()]
+
+        for idx, pattern in enumerate(patterns):
+            self.add_pattern(idx, pattern)
+        self.build_fail_links()
+
+    def add_pattern(self, idx: int, pattern: str) -> None:
+        state = 0
+        for ch in pattern:
+            nextState = self.goto[state].get(ch)
+            if nextState is None:
+                nextState = len(self.goto)
+                self.goto[state][ch] = nextState
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = nextState
+        self.output[state] += (idx,)
+
+    def build_fail_links(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nextState in self.goto[state].items():
+                queue.append(nextState)
+                failState = self.fail[state]
+                while failState and ch not in self.goto[failState]:
+                    failState = self.fail[failState]
+                self.fail[nextState] = self.goto[failState].get(ch, 0)
+                # a state also reports every pattern that is a suffix of it
+                self.output[nextState] += self.output[self.fail[nextState]]
+
+    def find_all(self, text: str) -> Set[int]:
+        goto, fail, output = self.goto, self.fail, self.output
+        found: Set[int] = set(output[0])
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
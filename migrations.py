@@ -0,0 +1,87 @@
+import logging
+from typing import List
+
+import dbif
+from enums import Settings
+
+ER_TABLE_EXISTS = 1050
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+
+# schema changes applied on top of setup.sql, the schema version of a DB is the number of migrations applied to it
+# (stored in the settings table) - never change an already released migration, append a new one instead
+# the statements depend on the DB backend, the list is built when migrating
+def get_migrations() -> List[List[str]]:
+    mysql = dbif.backend.name == 'mysql'
+    return [
+        # 1: indexes for the ordering and filters of get_transactions, duplicate checks and tag and signature lookups
+        [
+            'create index idx_transactions_due_date on transactions (dueDate, id)',
+            'create index idx_transactions_identifier on transactions (transactionIdentifier)',
+            'create index idx_transactions_type_date on transactions (trType, dueDate)',
+            'create index idx_transactions_category_date on transactions (category, dueDate)',
+            'create index idx_transactions_bank_date on transactions (bank, dueDate)',
+            'create index idx_tag_links_trans_cls on tag_links (trans_id, cls_id)',
+            'create index idx_tag_links_cls_trans on tag_links (cls_id, trans_id)',
+            'create index idx_signatures_cls on signatures (cls_id)',
+            'create index idx_classifications_type on classifications (type)',
+        ],
+        # 2: full-text index for the description filter - the ngram parser keeps the substring semantics of the former "like %...%",
+        #    stopwords would drop common two letter ngrams ("to", "in", ...) from the index; SQLite keeps using "like"
+        [
+            'set session innodb_ft_enable_stopword = 0',
+            'alter table transactions add fulltext index ft_transactions_signature (signature) with parser ngram',
+        ] if mysql else [],
+        # 3: monthly rollups for reporting, see dbif.update_rollups
+        [
+            '''create table rollups (
+                period date not null,
+                dim int not null,
+                dimKey int not null,
+                bank varchar(20) not null,
+                debit bigint not null,
+                credit bigint not null,
+                cnt int not null,
+                primary key (period, dim, dimKey, bank)
+            )''',
+            'delete from rollups',
+            f'''insert into rollups (period, dim, dimKey, bank, debit, credit, cnt)
+                select r.period, r.dim, r.dimKey, r.bank, r.debit, r.credit, r.cnt from ({dbif.rollup_select("1 = 1")}) as r''',
+        ],
+        # 4: modification time of the rows for incremental backups - the save functions set it explicitly, a change of the tags
+        #    alone does not update the row
+        #    (SQLite cannot add a column with a non-constant default)
+        [
+            'alter table transactions add column modifiedAt datetime not null default ' + ('current_timestamp' if mysql else "'1970-01-01 00:00:00'"),
+            'create index idx_transactions_modified on transactions (modifiedAt)',
+        ],
+    ]
+
+SCHEMA_VERSION = 4
+
+def get_schema_version() -> int:
+    version = dbif.get_setting(Settings.SCHEMA_VERSION.value)
+    return int(version) if version is not None else 0
+
+def run_statement(cursor, statement: str) -> None:
+    try:
+        cursor.execute(statement)
+    except dbif.backend.Error as e:
+        # DDL is not transactional in MySQL, a table, a column or an index may be left behind by a migration that failed halfway
+        if getattr(e, 'errno', None) not in (ER_TABLE_EXISTS, ER_DUP_FIELDNAME, ER_DUP_KEYNAME):
+            raise
+        logging.warning(f'skipping "{statement}": {e}')
+
+def migrate() -> int:
+    version = get_schema_version()
+    assert version <= SCHEMA_VERSION, f'DB {dbif.DB_NAME} has schema version {version}, newer than this application ({SCHEMA_VERSION})'
+
+    migrations = get_migrations()
+    assert len(migrations) == SCHEMA_VERSION, 'SCHEMA_VERSION does not match the migrations'
+    for newVersion in range(version + 1, SCHEMA_VERSION + 1):
+        logging.info(f'migrating DB {dbif.DB_NAME} to schema version {newVersion}')
+        with dbif.db_transaction() as cursor:
+            for statement in migrations[newVersion - 1]:
+                run_statement(cursor, statement)
+        dbif.set_setting(Settings.SCHEMA_VERSION.value, str(newVersion))
+    return SCHEMA_VERSION
@@ -0,0 +1,105 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+
+import dbif
+from importer import init_worker, get_mp_context
+from signatures import signatures
+from transaction import Transaction
+
+RECLASSIFY_CHUNK = 5000         # transactions read from the DB at once
+PARALLEL_MIN_ROWS = 50000       # below this the worker processes cost more than they save
+
+@dataclass
+class ClassificationChange:
+    id: int
+    oldTrType: Optional[int]
+    newTrType: Optional[int]
+    oldCategory: Optional[int]
+    newCategory: Optional[int]
+    addedTags: Tuple[int, ...]
+
+    def as_saved(self) -> Tuple[int, Optional[int], Optional[int], Tuple[int, ...]]:
+        return self.id, self.newTrType, self.newCategory, self.addedTags
+
+@dataclass
+class ReclassifyResult:
+    checkedCnt: int = 0
+    changes: List[ClassificationChange] = field(default_factory=list)
+    dryRun: bool = False
+
+    @property
+    def trTypeCnt(self) -> int:
+        return sum(1 for change in self.changes if change.oldTrType != change.newTrType)
+
+    @property
+    def categoryCnt(self) -> int:
+        return sum(1 for change in self.changes if change.oldCategory != change.newCategory)
+
+    @property
+    def tagLinkCnt(self) -> int:
+        return sum(len(change.addedTags) for change in self.changes)
+
+    def summary(self) -> str:
+        return (f'{"Would change" if self.dryRun else "Changed"} {len(self.changes)} of {self.checkedCnt} transactions: '
+                f'{self.trTypeCnt} types, {self.categoryCnt} categories, {self.tagLinkCnt} new tags')
+
+# the rows are sent to the workers as they come from the DB, only the changed transactions come back
+def classify_rows(rows: List[tuple]) -> List[ClassificationChange]:
+    changes: List[ClassificationChange] = []
+    for row in rows:
+        t = Transaction(*row)
+        trType, category, tags = t.trType, t.category, tuple(t.tags)
+        t.find_classifications()
+        if (t.trType, t.category) != (trType, category) or len(t.tags) != len(tags):
+            changes.append(ClassificationChange(t.id, trType, t.trType, category, t.category, tuple(t.tags)[len(tags):]))
+    return changes
+
+def iter_chunks(chunkSize: int) -> Iterator[List[tuple]]:
+    after: Optional[Tuple[date, int]] = None
+    while rows := dbif.get_transactions(after=after, limit=chunkSize):
+        yield rows
+        after = (rows[-1][1], rows[-1][0])
+
+# re-applies the current signatures to all stored transactions, the same way find_classifications does on import:
+# matched types and categories replace the stored ones and matched tags are added, nothing is cleared
+def reclassify(dryRun: bool = False, workers: Optional[int] = None, chunkSize: int = RECLASSIFY_CHUNK,
+               progress: Optional[Callable[[int, int], None]] = None) -> ReclassifyResult:
+    result = ReclassifyResult(dryRun=dryRun)
+    totalCnt = dbif.count_transactions()
+
+    def collect(rowCnt: int, changes: List[ClassificationChange]) -> None:
+        if not dryRun:
+            dbif.save_classifications([change.as_saved() for change in changes])
+        result.checkedCnt += rowCnt
+        result.changes += changes
+        if progress is not None:
+            progress(result.checkedCnt, totalCnt)
+
+    if totalCnt < PARALLEL_MIN_ROWS or workers == 1:
+        for rows in iter_chunks(chunkSize):
+            collect(len(rows), classify_rows(rows))
+        return result
+
+    workerCnt = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workerCnt, mp_context=get_mp_context(), initializer=init_worker,
+                             initargs=(signatures.snapshot(),)) as pool:
+        # a few chunks per worker are in flight, the history is never held in memory at once
+        maxPending = 2 * workerCnt
+        pending: Deque[Tuple[int, Future]] = deque()
+        for rows in iter_chunks(chunkSize):
+            pending.append((len(rows), pool.submit(classify_rows, rows)))
+            if len(pending) >= maxPending:
+                rowCnt, future = pending.popleft()
+                collect(rowCnt, future.result())
+        while pending:
+            rowCnt, future = pending.popleft()
+            collect(rowCnt, future.result())
+    return result
+
+def apply_changes(result: ReclassifyResult) -> None:
+    dbif.save_classifications([change.as_saved() for change in result.changes])
+    result.dryRun = False
@@ -0,0 +1,39 @@
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import dbif
+from enums import ClsType
+
+# reports are computed from the monthly rollups (see dbif.update_rollups), not from the transactions themselves
+
+# debit, credit and count per month per classification (None for unclassified)
+def monthly_totals(dim: ClsType, dateFrom: Optional[date] = None, dateTo: Optional[date] = None,
+                   bank: Optional[str] = None) -> Dict[date, Dict[Optional[int], Tuple[int, int, int]]]:
+    report: Dict[date, Dict[Optional[int], Tuple[int, int, int]]] = {}
+    for period, clsId, debit, credit, cnt in dbif.get_rollups(dim, dateFrom, dateTo, bank):
+        report.setdefault(period, {})[clsId] = (debit, credit, cnt)
+    return report
+
+# spend (sum of debits, as a negative number) per category per month
+def spend_per_category(dateFrom: Optional[date] = None, dateTo: Optional[date] = None,
+                       bank: Optional[str] = None) -> Dict[Optional[int], Dict[date, int]]:
+    report: Dict[Optional[int], Dict[date, int]] = {}
+    for period, categoryId, debit, _, _ in dbif.get_rollups(ClsType.CATEGORY, dateFrom, dateTo, bank):
+        if debit:
+            report.setdefault(categoryId, {})[period] = debit
+    return report
+
+# debit, credit and count per month per bank - every transaction has exactly one type row in the rollups
+def monthly_totals_per_bank(banks: List[str], dateFrom: Optional[date] = None,
+                            dateTo: Optional[date] = None) -> Dict[str, Dict[date, Tuple[int, int, int]]]:
+    report: Dict[str, Dict[date, Tuple[int, int, int]]] = {}
+    for bank in banks:
+        months: Dict[date, Tuple[int, int, int]] = {}
+        for period, _, debit, credit, cnt in dbif.get_rollups(ClsType.TR_TYPE, dateFrom, dateTo, bank):
+            prevDebit, prevCredit, prevCnt = months.get(period, (0, 0, 0))
+            months[period] = (prevDebit + debit, prevCredit + credit, prevCnt + cnt)
+        report[bank] = months
+    return report
+
+def rebuild() -> None:
+    dbif.rebuild_rollups()
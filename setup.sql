@@ -2,6 +2,8 @@
 -- use accounting2
 --
 -- mysql -p accounting2 < setup.sql
+--
+-- this is schema version 0, indexes and later changes are applied by migrations.py when the application starts
 drop table if exists settings;
 drop table if exists signatures;
 drop table if exists tag_links;
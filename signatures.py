@@ -1,18 +1,109 @@
-from typing import Dict
+import threading
+from typing import Dict, List, Optional, Set, Tuple
 
 import dbif
 from enums import ClsType
+from matcher import PatternMatcher
 
 class Signatures:
     def __init__(self):
-        self.tr_types: Dict[int, str] = {}
-        self.categories: Dict[int, str] = {}
-        self.tags: Dict[int, str] = {}
-        self.load()
+        self.tr_types: Dict[str, int] = {}
+        self.categories: Dict[str, int] = {}
+        self.tags: Dict[str, int] = {}
+        self.matcher = PatternMatcher([])
+        self.patternTargets: List[List[Tuple[ClsType, int, int]]] = []     # (classification type, priority, classification id) per pattern
+        # imports classify in the worker thread while the GUI edits the signatures - the dicts are replaced, not changed,
+        # and the matcher with its targets is swapped in as a whole under the lock
+        self.lock = threading.RLock()
+        # loaded on first use - worker processes get the signatures from the parent and must not touch the DB
+        self.loaded = False
+        # the matcher is rebuilt on the next match after signatures were added or removed, not after each change
+        self.matcherStale = False
 
     def load(self):
-        self.tr_types = dict(dbif.get_signatures_of_cls_type(ClsType.TR_TYPE))
-        self.categories = dict(dbif.get_signatures_of_cls_type(ClsType.CATEGORY))
-        self.tags = dict(dbif.get_signatures_of_cls_type(ClsType.TAG))
+        self.set_signatures(dict(dbif.get_signatures_of_cls_type(ClsType.TR_TYPE)),
+                            dict(dbif.get_signatures_of_cls_type(ClsType.CATEGORY)),
+                            dict(dbif.get_signatures_of_cls_type(ClsType.TAG)))
 
-signatures = Signatures()
\ No newline at end of file
+    def set_signatures(self, trTypes: Dict[str, int], categories: Dict[str, int], tags: Dict[str, int]) -> None:
+        with self.lock:
+            self.tr_types, self.categories, self.tags = trTypes, categories, tags
+            self.build_matcher()
+            self.loaded = True
+
+    def replace_of_type(self, clsType: ClsType, sigs: Dict[str, int]) -> None:
+        if clsType == ClsType.TR_TYPE:
+            self.tr_types = sigs
+        elif clsType == ClsType.CATEGORY:
+            self.categories = sigs
+        else:
+            self.tags = sigs
+
+    def of_type(self, clsType: ClsType) -> Dict[str, int]:
+        return {ClsType.TR_TYPE: self.tr_types, ClsType.CATEGORY: self.categories, ClsType.TAG: self.tags}[clsType]
+
+    # call after the signature was saved, a new signature has the highest id and so the lowest priority
+    def add(self, clsType: ClsType, signature: str, clsId: int) -> None:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                return
+            self.replace_of_type(clsType, {**self.of_type(clsType), signature: clsId})
+            self.matcherStale = True
+
+    def remove(self, clsType: ClsType, signature: str, clsId: int) -> None:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                return
+            sigs = self.of_type(clsType)
+            if sigs.get(signature) == clsId:
+                self.replace_of_type(clsType, {sig: i for sig, i in sigs.items() if sig != signature})
+                self.matcherStale = True
+
+    def snapshot(self) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self.tr_types, self.categories, self.tags
+
+    def build_matcher(self) -> None:
+        with self.lock:
+            patternIdx: Dict[str, int] = {}
+            patternTargets: List[List[Tuple[ClsType, int, int]]] = []
+            for clsType, sigs in ((ClsType.TR_TYPE, self.tr_types), (ClsType.CATEGORY, self.categories), (ClsType.TAG, self.tags)):
+                # the priority is the position in the dict, the first matching type and category wins
+                for priority, (sig, clsId) in enumerate(sigs.items()):
+                    if sig is None:
+                        continue
+                    idx = patternIdx.setdefault(sig.lower(), len(patternIdx))
+                    if idx == len(patternTargets):
+                        patternTargets.append([])
+                    patternTargets[idx].append((clsType, priority, clsId))
+            self.matcher, self.patternTargets = PatternMatcher(list(patternIdx.keys())), patternTargets
+            self.matcherStale = False
+
+    def match(self, signature: str) -> Tuple[Optional[int], Optional[int], Set[int]]:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.matcherStale:
+                self.build_matcher()
+            # the matcher and the targets that belong to it, a rebuild after this does not touch them
+            matcher, patternTargets = self.matcher, self.patternTargets
+            trTypePriority, categoryPriority = len(self.tr_types), len(self.categories)
+        trType, category = None, None
+        tags: Set[int] = set()
+
+        for idx in matcher.find_all(signature):
+            for clsType, priority, clsId in patternTargets[idx]:
+                if clsType == ClsType.TAG:
+                    tags.add(clsId)
+                elif clsType == ClsType.TR_TYPE and priority < trTypePriority:
+                    trType, trTypePriority = clsId, priority
+                elif clsType == ClsType.CATEGORY and priority < categoryPriority:
+                    category, categoryPriority = clsId, priority
+
+        return trType, category, tags
+
+signatures = Signatures()
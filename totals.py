@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from transaction import Transaction
+from transaction_store import TransactionStore, NO_VALUE
+
+# sums of the shown transactions, kept up to date row by row instead of rescanning all rows after every change
+class RunningTotals:
+    def __init__(self):
+        self.debit = 0
+        self.credit = 0
+        self.count = 0
+        self.byTrType: Dict[Optional[int], int] = {}
+        self.byCategory: Dict[Optional[int], int] = {}
+
+    @staticmethod
+    def from_store(store: TransactionStore, rows: Iterable[int]) -> 'RunningTotals':
+        rows = list(rows)
+        totals = RunningTotals()
+        totals.debit, totals.credit, totals.count = store.totals(rows)
+        totals.byTrType = {(key if key != NO_VALUE else None): value for key, value in store.sum_by(rows, 'trTypes').items()}
+        totals.byCategory = {(key if key != NO_VALUE else None): value for key, value in store.sum_by(rows, 'categories').items()}
+        return totals
+
+    @staticmethod
+    def from_aggregates(aggregates: Iterable[Tuple[Optional[int], Optional[int], int, int, int]]) -> 'RunningTotals':
+        totals = RunningTotals()
+        for trType, category, debit, credit, count in aggregates:
+            totals.debit += debit
+            totals.credit += credit
+            totals.count += count
+            totals.byTrType[trType] = totals.byTrType.get(trType, 0) + debit + credit
+            totals.byCategory[category] = totals.byCategory.get(category, 0) + debit + credit
+        return totals
+
+    @property
+    def total(self) -> int:
+        return self.debit + self.credit
+
+    def add(self, t: Transaction) -> None:
+        self.apply(t, 1)
+
+    def remove(self, t: Transaction) -> None:
+        self.apply(t, -1)
+
+    def apply(self, t: Transaction, sign: int) -> None:
+        amount = sign * t.amount
+        if t.amount < 0:
+            self.debit += amount
+        else:
+            self.credit += amount
+        self.count += sign
+        self.byTrType[t.trType] = self.byTrType.get(t.trType, 0) + amount
+        self.byCategory[t.category] = self.byCategory.get(t.category, 0) + amount
+
+    # wraps a change of the amount or the classification of a transaction that is included in the totals
+    @contextmanager
+    def changing(self, t: Transaction) -> Iterator[None]:
+        self.remove(t)
+        try:
+            yield
+        finally:
+            self.add(t)
@@ -1,23 +1,58 @@
 from __future__ import annotations
-from typing import Optional, Set
+from collections.abc import MutableSet
+from typing import Optional, Set, List, Iterable, Iterator, Tuple
 
 from dataclasses import dataclass, field, InitVar
 import datetime
+import sys
 
 import dbif
-from enums import TransactionStatus
+from enums import ClsType, TransactionStatus
 from signatures import signatures
 from utils import remove_extra_spaces
 
 TR_TYPE_CREDIT = 5
 CATEGORY_CREDIT = 16
 
+DESCRIPTION_FIELDS = ('systemDescription', 'senderDescription', 'addresseeDescription', 'AV1', 'AV2', 'AV3', 'AV4')
+
 @dataclass
 class Tag:
     id: int
     name: str
 
-@dataclass
+# set of tag ids kept in a tuple - a transaction has only a few tags and an empty set costs more memory than the whole tuple
+class TagSet(MutableSet):
+    __slots__ = ('items',)
+
+    def __init__(self, items: Iterable[int] = ()):
+        self.items: Tuple[int, ...] = tuple(dict.fromkeys(items))
+
+    def __contains__(self, tagId: object) -> bool:
+        return tagId in self.items
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __repr__(self) -> str:
+        return f'TagSet({set(self.items)})'
+
+    def add(self, tagId: int) -> None:
+        if tagId not in self.items:
+            self.items += (tagId,)
+
+    def discard(self, tagId: int) -> None:
+        if tagId in self.items:
+            self.items = tuple(t for t in self.items if t != tagId)
+
+    def update(self, tagIds: Iterable[int]) -> None:
+        for tagId in tagIds:
+            self.add(tagId)
+
+@dataclass(slots=True)
 class Transaction:
     id: Optional[int]           # in table
     dueDate: datetime.date      # in table
@@ -48,23 +83,38 @@ class Transaction:
     AV4: Optional[str] = None                       # in details
     initTags: InitVar[Optional[str]] = None         # tags are passed as str, but need to be converted to set in __post_init__
 
-    tags: Set[int] = field(init=False, repr=False)
+    tags: TagSet = field(init=False, repr=False)
     status: TransactionStatus = field(default=TransactionStatus.SAVED, repr=False)
-    signature: str = field(default='', init=False, repr=False)
+    cachedSignature: Optional[str] = field(default=None, init=False, repr=False, compare=False)    # see signature
+    savedTags: Tuple[int, ...] = field(default=(), init=False, repr=False, compare=False)          # tags as they are in the DB
 
     def __post_init__(self, initTags: str | None):
-        for fieldName in ['systemDescription', 'senderDescription', 'addresseeDescription', 'AV1', 'AV2', 'AV3', 'AV4']:
+        for fieldName in DESCRIPTION_FIELDS:
             fld = getattr(self, fieldName)
-            if fld is not None:
-                newField = remove_extra_spaces(fld).strip()
-                setattr(self, fieldName, newField if newField else None)
+            if fld:
+                # remove_extra_spaces also strips the field
+                setattr(self, fieldName, remove_extra_spaces(fld) or None)
+            elif fld is not None:
+                setattr(self, fieldName, None)
+
+        # the same few strings repeat in every row
+        self.bank = sys.intern(self.bank)
+        if self.originalCurrency is not None:
+            self.originalCurrency = sys.intern(self.originalCurrency)
 
-        if not self.signature:
-            self.signature = self.make_signature()
         if initTags is None:
-            self.tags = set()
+            self.tags = TagSet()
         else:
-            self.tags = {int(t) for t in initTags.split(',')}
+            self.tags = TagSet(int(t) for t in initTags.split(','))
+        if self.id is not None:
+            self.savedTags = tuple(self.tags)
+
+    # built on first use, most rows loaded from the DB are never classified nor saved
+    @property
+    def signature(self) -> str:
+        if self.cachedSignature is None:
+            self.cachedSignature = self.make_signature()
+        return self.cachedSignature
 
     def make_signature(self) -> str:
         nonEmptyFields: filter[str] = filter(None, [self.toAccount, self.toAccountName, self.variableSymbol, self.constantSymbol, self.specificSymbol,
@@ -72,65 +122,83 @@ class Transaction:
                                        self.AV1, self.AV2, self.AV3, self.AV4])
         return ','.join(nonEmptyFields).lower()
 
-    def save(self) -> int:
+    def is_complete(self) -> bool:
         # TODO: transaction should always have: dueDate, amount, category, trType, bank
+        return self.trType is not None and self.category is not None
+
+    def save(self) -> int:
+        assert isinstance(self.tags, TagSet), "transaction tags are not a TagSet"
         if self.id is None:
             self.id = dbif.save_new_transaction(self)
         else:
-            dbif.save_modified_transaction(self)
+            # the tags are diffed against the ones loaded from the DB, no need to read them again
+            dbif.save_modified_transaction(self, set(self.tags) - set(self.savedTags), set(self.savedTags) - set(self.tags))
 
         assert self.id is not None, "transaction id is None after saving"
-        assert isinstance(self.tags, set), "transaction tags are not a set"
-
-        tagsIdsFromDB = list(map(lambda x: x[0], dbif.get_tags(self.id)))
-        tagsToRemove = set(tagsIdsFromDB) - set(self.tags)
-        if tagsToRemove:
-            dbif.remove_tags(self.id, tagsToRemove)
-
-        tagsToAdd = set(self.tags) - set(tagsIdsFromDB)
-        if tagsToAdd:
-            dbif.add_tags(self.id, tagsToAdd)
-
+        self.mark_saved()
         return self.id
 
+    # savedTags are the tags written, when they were taken before the save
+    def mark_saved(self, savedTags: Optional[Iterable[int]] = None) -> None:
+        self.status = TransactionStatus.SAVED
+        self.savedTags = tuple(self.tags if savedTags is None else savedTags)
+
     def delete(self):
         dbif.remove_transaction(self.id)
 
-    def is_duplicate(self) -> bool:
-        return dbif.find_transaction_by_identifier(self.transactionIdentifier)
+    @staticmethod
+    def mark_duplicates(transactions: List[Transaction], seenIdentifiers: Optional[Set[str]] = None) -> int:
+        # marks transactions already in the DB and repeated occurrences within the batch, the first occurrence stays as it is
+        if seenIdentifiers is None:
+            seenIdentifiers = set()
+        existing = dbif.find_existing_identifiers(t.transactionIdentifier for t in transactions)
+
+        duplicateCnt = 0
+        for t in transactions:
+            identifier = t.transactionIdentifier
+            if not identifier:
+                continue
+            if identifier in existing or identifier in seenIdentifiers:
+                t.status = TransactionStatus.DUPLICATE
+                duplicateCnt += 1
+            seenIdentifiers.add(identifier)
+        return duplicateCnt
 
     def find_classifications(self) -> None:
-        self.find_tr_type()
-        self.find_category()
-        self.find_tags()
+        assert isinstance(self.tags, TagSet), "transaction tags are not a TagSet"
+        trType, category, tags = signatures.match(self.signature)
 
-    def find_tr_type(self) -> None:
         if self.amount > 0:
             self.trType = TR_TYPE_CREDIT
-            return
-
-        for sig, trTypeId in signatures.tr_types.items():
-            try:
-                if sig.lower() in self.signature:
-                    self.trType = trTypeId
-                    return
-            except TypeError as e:
-                raise e
-
-    def find_category(self) -> None:
-        if self.amount > 0:
             self.category = CATEGORY_CREDIT
-            return
-        for sig, categoryId in signatures.categories.items():
-            if sig.lower() in self.signature:
-                self.category = categoryId
-                return
-
-    def find_tags(self) -> None:
-        assert isinstance(self.tags, set), "transaction tags are not a set"
-        for sig, tagId in signatures.tags.items():
-            if sig.lower() in self.signature:
-                self.tags.add(tagId)
+        else:
+            if trType is not None:
+                self.trType = trType
+            if category is not None:
+                self.category = category
+        self.tags.update(tags)
+
+    # re-applies the signatures after a signature of the classification was added or removed, matchedBefore is what the
+    # signatures gave before the change - only values that came from them (or are unset) follow the change, a type,
+    # category or tag chosen by hand stays; returns whether the transaction changed
+    def rematch(self, clsType: ClsType, clsId: int, matchedBefore: Tuple[Optional[int], Optional[int], Set[int]]) -> bool:
+        trType, category, tags = signatures.match(self.signature)
+        trTypeBefore, categoryBefore, tagsBefore = matchedBefore
+        before = (self.trType, self.category, self.tags.items)
+
+        if clsType == ClsType.TAG:
+            if clsId in tags and clsId not in tagsBefore:
+                self.tags.add(clsId)
+            elif clsId in tagsBefore and clsId not in tags:
+                self.tags.discard(clsId)
+        elif self.amount <= 0:
+            # credits are classified by the amount, not by signatures
+            if clsType == ClsType.TR_TYPE and trType != trTypeBefore and self.trType in (trTypeBefore, None):
+                self.trType = trType
+            elif clsType == ClsType.CATEGORY and category != categoryBefore and self.category in (categoryBefore, None):
+                self.category = category
+
+        return (self.trType, self.category, self.tags.items) != before
 
     @staticmethod
     def reload_signatures():
@@ -0,0 +1,61 @@
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, List, Optional
+
+import dbif
+
+@dataclass
+class TransactionFilter:
+    dateFrom: Optional[date] = None
+    dateTo: Optional[date] = None
+    amountMin: Optional[int] = None     # absolute value, in whole crowns
+    amountMax: Optional[int] = None     # absolute value, in whole crowns
+    description: str = ''
+    credit: Optional[bool] = None       # True - only credit, False - only debit, None - both
+    bank: Optional[str] = None
+    trTypes: List[int] = field(default_factory=list)
+    categories: List[int] = field(default_factory=list)
+    tags: List[int] = field(default_factory=list)
+
+    # where clause and its parameters for dbif.get_transactions and dbif.get_transaction_totals
+    def to_sql(self) -> dbif.SqlFilter:
+        filters: List[str] = []
+        params: List[Any] = []
+
+        if self.dateFrom is not None:
+            filters.append('t.dueDate >= %s')
+            params.append(self.dateFrom)
+        if self.dateTo is not None:
+            filters.append('t.dueDate <= %s')
+            params.append(self.dateTo)
+        if self.amountMin is not None:
+            filters.append('abs(t.amount) >= 100 * %s')
+            params.append(self.amountMin)
+        if self.amountMax is not None:
+            filters.append('abs(t.amount) <= 100 * %s')
+            params.append(self.amountMax)
+
+        if self.description:
+            descFilter, descParams = dbif.description_filter(self.description)
+            if descFilter:
+                filters.append(descFilter)
+                params += descParams
+        if self.credit is True:
+            filters.append('t.amount >= 0')
+        if self.credit is False:
+            filters.append('t.amount < 0')
+        if self.bank is not None:
+            # the GUI passes 'kb' and 'mb', the rows have 'KB' and 'MB'
+            filters.append(dbif.backend.equals_ignore_case('t.bank'))
+            params.append(self.bank)
+
+        for column, values in (('t.trType', self.trTypes), ('t.category', self.categories)):
+            if values:
+                filters.append(f'{column} in ({",".join(["%s"] * len(values))})')
+                params += values
+        # not on the joined tag links, those must stay complete - the rows carry all their tags whatever the filter
+        if self.tags:
+            filters.append(f'exists (select 1 from tag_links as ft where ft.trans_id = t.id and ft.cls_id in ({",".join(["%s"] * len(self.tags))}))')
+            params += self.tags
+
+        return (f' where {" and ".join(filters)}' if filters else ''), params
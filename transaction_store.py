@@ -0,0 +1,188 @@
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from enums import TransactionStatus
+from transaction import Transaction
+from transaction_filter import TransactionFilter
+from utils import description_words
+
+NO_VALUE = -1       # stands for None in the integer columns
+GRAM_SIZE = 3       # length of the signature substrings in the signature index
+
+STATUSES = list(TransactionStatus)
+
+# the loaded transactions kept column by column, so that re-filtering, sorting and aggregating them does not need the DB
+# rows are never moved, a removed row is only marked as not alive
+class TransactionStore:
+    def __init__(self, transactions: Iterable[Transaction] = ()):
+        self.transactions: List[Transaction] = []
+        self.rowOf: Dict[int, int] = {}     # id() of a transaction -> its row
+
+        self.ids = array('q')
+        self.dueDates = array('l')          # date ordinals
+        self.amounts = array('q')
+        self.trTypes = array('l')
+        self.categories = array('l')
+        self.banks = array('B')             # index into bankNames
+        self.statuses = array('B')          # index into STATUSES
+        self.alive = array('B')
+        self.tagRows: Dict[int, int] = {}   # tag id -> bitmap of the rows with the tag
+        self.gramRows: Optional[Dict[str, array]] = None     # signature trigram -> rows containing it, built on first use
+
+        self.bankNames: List[str] = []
+        self.extend(transactions)
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def bank_index(self, bank: str) -> int:
+        bank = bank.lower()
+        if bank not in self.bankNames:
+            self.bankNames.append(bank)
+        return self.bankNames.index(bank)
+
+    def extend(self, transactions: Iterable[Transaction]) -> None:
+        newTagRows: Dict[int, List[int]] = {}
+        firstRow = len(self.transactions)
+        for t in transactions:
+            row = len(self.transactions)
+            self.transactions.append(t)
+            self.rowOf[id(t)] = row
+            self.ids.append(t.id if t.id is not None else NO_VALUE)
+            self.dueDates.append(t.dueDate.toordinal())
+            self.amounts.append(t.amount)
+            self.trTypes.append(t.trType if t.trType is not None else NO_VALUE)
+            self.categories.append(t.category if t.category is not None else NO_VALUE)
+            self.banks.append(self.bank_index(t.bank))
+            self.statuses.append(STATUSES.index(t.status))
+            self.alive.append(1)
+            for tagId in t.tags:
+                newTagRows.setdefault(tagId, []).append(row)
+
+        # setting the bits one by one in a big int would copy the whole bitmap every time
+        bitmapBytes = (len(self.transactions) + 7) // 8
+        for tagId, rows in newTagRows.items():
+            bits = bytearray(self.tagRows.get(tagId, 0).to_bytes(bitmapBytes, 'little'))
+            for row in rows:
+                bits[row >> 3] |= 1 << (row & 7)
+            self.tagRows[tagId] = int.from_bytes(bits, 'little')
+
+        if self.gramRows is not None:
+            self.index_signatures(range(firstRow, len(self.transactions)))
+
+    def index_signatures(self, rows: Iterable[int]) -> None:
+        gramRows = self.gramRows
+        for row in rows:
+            signature = self.transactions[row].signature
+            for gram in {signature[i:i + GRAM_SIZE] for i in range(len(signature) - GRAM_SIZE + 1)}:
+                if (postings := gramRows.get(gram)) is None:
+                    postings = gramRows[gram] = array('l')
+                postings.append(row)
+
+    # rows whose signature contains the text, only the rows having the rarest trigram of the text are checked
+    def rows_containing(self, text: str) -> List[int]:
+        text = text.lower()
+        transactions = self.transactions
+        if len(text) < GRAM_SIZE:
+            candidates: Iterable[int] = range(len(transactions))
+        else:
+            if self.gramRows is None:
+                self.gramRows = {}
+                self.index_signatures(range(len(transactions)))
+            gramRows = self.gramRows
+            candidates = min((gramRows.get(text[i:i + GRAM_SIZE], ()) for i in range(len(text) - GRAM_SIZE + 1)), key=len)
+        alive = self.alive
+        return [row for row in candidates if alive[row] and text in transactions[row].signature]
+
+    # call after a loaded transaction was changed
+    def update(self, t: Transaction) -> None:
+        row = self.rowOf[id(t)]
+        self.ids[row] = t.id if t.id is not None else NO_VALUE
+        self.amounts[row] = t.amount
+        self.trTypes[row] = t.trType if t.trType is not None else NO_VALUE
+        self.categories[row] = t.category if t.category is not None else NO_VALUE
+        self.statuses[row] = STATUSES.index(t.status)
+
+        rowBit = 1 << row
+        for tagId, bitmap in self.tagRows.items():
+            if bitmap & rowBit and tagId not in t.tags:
+                self.tagRows[tagId] = bitmap & ~rowBit
+        for tagId in t.tags:
+            self.tagRows[tagId] = self.tagRows.get(tagId, 0) | rowBit
+
+    def remove(self, t: Transaction) -> None:
+        self.alive[self.rowOf[id(t)]] = 0
+
+    def rows_of(self, transactions: Iterable[Transaction]) -> List[int]:
+        return [self.rowOf[id(t)] for t in transactions]
+
+    def get_transactions(self, rows: Iterable[int]) -> List[Transaction]:
+        return [self.transactions[row] for row in rows]
+
+    def select(self, flt: TransactionFilter) -> List[int]:
+        alive = self.alive
+        rows = [row for row in range(len(self.transactions)) if alive[row]]
+
+        if flt.dateFrom is not None or flt.dateTo is not None:
+            dueDates = self.dueDates
+            dateFrom = flt.dateFrom.toordinal() if flt.dateFrom is not None else 0
+            dateTo = flt.dateTo.toordinal() if flt.dateTo is not None else float('inf')
+            rows = [row for row in rows if dateFrom <= dueDates[row] <= dateTo]
+
+        amounts = self.amounts
+        if flt.amountMin is not None or flt.amountMax is not None:
+            amountMin = 100 * flt.amountMin if flt.amountMin is not None else 0
+            amountMax = 100 * flt.amountMax if flt.amountMax is not None else float('inf')
+            rows = [row for row in rows if amountMin <= abs(amounts[row]) <= amountMax]
+        if flt.credit is True:
+            rows = [row for row in rows if amounts[row] >= 0]
+        if flt.credit is False:
+            rows = [row for row in rows if amounts[row] < 0]
+
+        if flt.bank is not None:
+            bankIdx = self.bank_index(flt.bank)
+            banks = self.banks
+            rows = [row for row in rows if banks[row] == bankIdx]
+        if flt.trTypes:
+            rows = self.filter_in(rows, self.trTypes, flt.trTypes)
+        if flt.categories:
+            rows = self.filter_in(rows, self.categories, flt.categories)
+        if flt.tags:
+            tagBitmap = 0
+            for tagId in flt.tags:
+                tagBitmap |= self.tagRows.get(tagId, 0)
+            bits = tagBitmap.to_bytes((len(self.transactions) + 7) // 8, 'little')
+            rows = [row for row in rows if bits[row >> 3] >> (row & 7) & 1]
+
+        if flt.description:
+            # same as the full-text filter: every word has to be contained in the signature
+            words = description_words(flt.description)
+            transactions = self.transactions
+            rows = [row for row in rows if all(word in transactions[row].signature for word in words)]
+
+        return rows
+
+    @staticmethod
+    def filter_in(rows: List[int], column: array, values: List[int]) -> List[int]:
+        valueSet = set(values)
+        return [row for row in rows if column[row] in valueSet]
+
+    def sort(self, rows: List[int], column: str, reverse: bool = False, keyMap: Optional[Callable[[int], Any]] = None) -> List[int]:
+        values: array = getattr(self, column)
+        if keyMap is None:
+            return sorted(rows, key=values.__getitem__, reverse=reverse)
+        return sorted(rows, key=lambda row: keyMap(values[row]), reverse=reverse)
+
+    def totals(self, rows: Iterable[int]) -> Tuple[int, int, int]:
+        amounts = [self.amounts[row] for row in rows]
+        sumDebit = sum(amount for amount in amounts if amount < 0)
+        sumCredit = sum(amount for amount in amounts if amount >= 0)
+        return sumDebit, sumCredit, len(amounts)
+
+    # sum of amounts per value of the column (trTypes, categories, banks), NO_VALUE collects the unclassified rows
+    def sum_by(self, rows: Iterable[int], column: str) -> Dict[int, int]:
+        values: array = getattr(self, column)
+        sums: Dict[int, int] = {}
+        for row in rows:
+            sums[values[row]] = sums.get(values[row], 0) + self.amounts[row]
+        return sums
@@ -1,18 +1,12 @@
-from datetime import date
+from typing import List
 
 def display_amount(amount: int) -> str:
     return f'{"-" if amount < 0 else ""}{(abs(amount) // 100):_},{abs(amount) % 100:02d}'.replace('_', ' ')
 
-def value_or_null(obj, name: str, commas: bool = True) -> str:
-    optionalComma = ', ' if commas else ''
-    value = getattr(obj, name)
-    if value is None:
-        strValue = 'null'
-    elif isinstance(value, (str, date)):
-        strValue = f'"{value}"'
-    else:
-        strValue = str(value)
-    return f'{optionalComma}{strValue}'
-
 def remove_extra_spaces(s: str) -> str:
     return ' '.join(s.split())
+
+# the words of a description filter, the same for the DB and for the loaded rows - the full-text operators are dropped
+def description_words(text: str) -> List[str]:
+    words = (word.strip('+-<>()~*@').replace('"', '') for word in text.lower().split())
+    return [word for word in words if word]
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import PySimpleGUI as sg
+
+import instrumentation
+
+WORKER_EVENT = '-worker-'       # values[WORKER_EVENT] is (job, kind, payload), kind is one of the JOB_* below
+
+JOB_PROGRESS = 'progress'       # payload (done, total, text)
+JOB_PARTIAL = 'partial'         # payload is a part of the result, e.g. a chunk of imported transactions
+JOB_DONE = 'done'               # payload is the return value of the job function
+JOB_FAILED = 'failed'           # payload is the exception
+JOB_CANCELLED = 'cancelled'
+
+class JobCancelled(Exception):
+    pass
+
+# the job function runs in the worker thread and must not touch the window, it reports through the job instead
+class Job:
+    def __init__(self, window: sg.Window, name: str, func: Callable[['Job'], Any], onDone: Optional[Callable[[Any], None]],
+                 onPartial: Optional[Callable[[Any], None]], onFailed: Optional[Callable[[Exception], None]], cancellable: bool):
+        self.window = window
+        self.name = name
+        self.func = func
+        self.onDone = onDone
+        self.onPartial = onPartial
+        self.onFailed = onFailed
+        # a job whose result must reach the application, e.g. because it writes to the DB, runs to its end
+        self.cancellable = cancellable
+        self.cancelRequested = threading.Event()
+        # the GUI thread cancels and the worker thread ends the cancellable part under it, one of them wins
+        self.cancelLock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelRequested.is_set()
+
+    def check_cancelled(self) -> None:
+        if self.cancelled:
+            raise JobCancelled()
+
+    # called by the job function where it starts changing what it must not leave half done, raises if it was cancelled before
+    def end_cancellable(self) -> None:
+        with self.cancelLock:
+            self.check_cancelled()
+            self.cancellable = False
+        # the progress update disables the cancel button
+        self.window.write_event_value(WORKER_EVENT, (self, JOB_PROGRESS, (0, 0, f'{self.name}, finishing')))
+
+    # reporting progress is also where a cancelled job stops
+    def progress(self, done: int, total: int, text: str = '') -> None:
+        self.check_cancelled()
+        self.window.write_event_value(WORKER_EVENT, (self, JOB_PROGRESS, (done, total, text)))
+
+    def publish(self, partialResult: Any) -> None:
+        self.check_cancelled()
+        self.window.write_event_value(WORKER_EVENT, (self, JOB_PARTIAL, partialResult))
+
+# runs one long operation at a time in a thread, results come back as window events and the callbacks are called from
+# the event loop, so only the GUI thread touches the window and the application state
+class BackgroundWorker:
+    def __init__(self, window: sg.Window):
+        self.window = window
+        self.job: Optional[Job] = None
+
+    @property
+    def busy(self) -> bool:
+        return self.job is not None
+
+    def ensure_idle(self) -> bool:
+        if self.job is not None:
+            sg.popup(f'Wait until "{self.job.name}" finishes or cancel it', title='Busy')
+            return False
+        return True
+
+    def start(self, name: str, func: Callable[[Job], Any], onDone: Optional[Callable[[Any], None]] = None,
+              onPartial: Optional[Callable[[Any], None]] = None, onFailed: Optional[Callable[[Exception], None]] = None,
+              cancellable: bool = True) -> bool:
+        if not self.ensure_idle():
+            return False
+        self.job = Job(self.window, name, func, onDone, onPartial, onFailed, cancellable)
+        self.show_progress(name, 0, 0)
+        threading.Thread(target=self.run_job, args=(self.job,), name=f'worker: {name}', daemon=True).start()
+        return True
+
+    @staticmethod
+    def run_job(job: Job) -> None:
+        start = time.perf_counter()
+        try:
+            result = job.func(job)
+            instrumentation.record(instrumentation.KIND_JOB, job.name, time.perf_counter() - start)
+            job.window.write_event_value(WORKER_EVENT, (job, JOB_CANCELLED if job.cancelled else JOB_DONE, result))
+        except JobCancelled:
+            job.window.write_event_value(WORKER_EVENT, (job, JOB_CANCELLED, None))
+        except Exception as e:
+            logging.exception(f'{job.name} failed')
+            job.window.write_event_value(WORKER_EVENT, (job, JOB_FAILED, e))
+
+    # the job stops at its next progress report, what it already published stays, returns False when the job cannot
+    # be cancelled and keeps running
+    def cancel(self) -> bool:
+        if self.job is None:
+            return True
+        with self.job.cancelLock:
+            if self.job.cancellable:
+                self.job.cancelRequested.set()
+        if not self.job.cancelled:
+            sg.popup(f'"{self.job.name}" cannot be cancelled, wait until it finishes', title='Busy')
+            return False
+        logging.info(f'{self.job.name} cancelled')
+        self.job = None
+        self.hide_progress()
+        return True
+
+    def handle_event(self, payload: Any) -> None:
+        job, kind, value = payload
+        # events of a cancelled job that were already queued are dropped
+        if job is not self.job:
+            return
+
+        if kind == JOB_PROGRESS:
+            done, total, text = value
+            self.show_progress(text or job.name, done, total)
+        elif kind == JOB_PARTIAL:
+            if job.onPartial is not None:
+                job.onPartial(value)
+        else:
+            self.job = None
+            self.hide_progress()
+            if kind == JOB_DONE and job.onDone is not None:
+                job.onDone(value)
+            elif kind == JOB_FAILED:
+                if job.onFailed is not None:
+                    job.onFailed(value)
+                else:
+                    sg.popup(f'{job.name} failed: {value}', title='Error')
+
+    def show_progress(self, text: str, done: int, total: int) -> None:
+        self.window['txt_job'].update(text)
+        self.window['progress_job'].update(current_count=done, max=max(total, 1))
+        self.window['btn_cancel_job'].update(disabled=self.job is not None and not self.job.cancellable)
+
+    def hide_progress(self) -> None:
+        self.window['txt_job'].update('')
+        self.window['progress_job'].update(current_count=0, max=1)
+        self.window['btn_cancel_job'].update(disabled=True)